@@ -8,9 +8,13 @@ import threading
 import time
 import base64
 import json
+import hashlib
+import hmac
 import secrets
 import tempfile
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timezone
 
 # Startup ENV check (names only, no values) for Railway
@@ -20,10 +24,12 @@ print("ENV CHECK: LINE_CHANNEL_ACCESS_TOKEN exists:", bool(os.getenv("LINE_CHANN
 print("ENV CHECK: LINE_CHANNEL_SECRET exists:", bool(os.getenv("LINE_CHANNEL_SECRET")))
 print("ENV CHECK: OPENAI_API_KEY exists:", bool(os.getenv("OPENAI_API_KEY")))
 
-from flask import Flask, request, abort, Response
+from flask import Flask, request, abort, Response, send_file
 import requests
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from linebot.webhook import SignatureValidator
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, PostbackEvent, AudioMessage, ImageMessage,
     QuickReply, QuickReplyButton, MessageAction, PostbackAction, FlexSendMessage, URIAction,
@@ -31,7 +37,7 @@ from linebot.models import (
 from linebot.models.send_messages import AudioSendMessage
 from redis import Redis as RedisClient
 from pymongo import MongoClient
-from openai import OpenAI
+from openai import OpenAI, APITimeoutError
 import httpx
 from httpx_retries import RetryTransport, Retry
 import cloudinary
@@ -41,7 +47,6 @@ try:
     from api.syllabus import (
         is_off_topic,
         get_rag_instructions,
-        get_writing_mode_instructions,
         is_course_inquiry_intent,
         build_course_inquiry_flex,
         get_now_taipei,
@@ -62,13 +67,13 @@ try:
         get_user_state,
         set_quiz_data,
         get_quiz_data,
+        get_quiz_state_and_data,
         clear_quiz_data,
         STATE_NORMAL,
         STATE_QUIZ_WAITING,
         record_weak_category,
-        get_weak_categories,
+        get_review_ask_state,
         clear_weak_category,
-        get_last_review_ask,
         set_last_review_ask,
         set_pending_review_category,
         get_pending_review_category,
@@ -80,6 +85,7 @@ try:
         generate_review_note,
         set_mcq_quiz_data,
     )
+    from api.semcache import lookup as semcache_lookup, store as semcache_store
     from api.research_logging import (
         ensure_user,
         get_interaction_count,
@@ -101,7 +107,6 @@ except ImportError:
     from syllabus import (
         is_off_topic,
         get_rag_instructions,
-        get_writing_mode_instructions,
         is_course_inquiry_intent,
         build_course_inquiry_flex,
         get_now_taipei,
@@ -122,13 +127,13 @@ except ImportError:
         get_user_state,
         set_quiz_data,
         get_quiz_data,
+        get_quiz_state_and_data,
         clear_quiz_data,
         STATE_NORMAL,
         STATE_QUIZ_WAITING,
         record_weak_category,
-        get_weak_categories,
+        get_review_ask_state,
         clear_weak_category,
-        get_last_review_ask,
         set_last_review_ask,
         set_pending_review_category,
         get_pending_review_category,
@@ -140,6 +145,7 @@ except ImportError:
         generate_review_note,
         set_mcq_quiz_data,
     )
+    from semcache import lookup as semcache_lookup, store as semcache_store
     from research_logging import (
         ensure_user,
         get_interaction_count,
@@ -192,20 +198,86 @@ except ImportError:
         append_conv_history = lambda *a, **k: None
         get_conv_history = lambda *a, **k: []
 
+class _PooledRequestsHttpClient(RequestsHttpClient):
+    """LINE SDK 預設每次 requests.get/post 都新建連線；改用共用 Session 保持 keep-alive。"""
+
+    _session = requests.Session()
+    # pool_maxsize 對齊背景池總 worker 數（webhook/fanout/media/background 各 8），爆量時連線不被丟棄重握手；
+    # 只重試連線建立失敗（請求尚未送出），push/reply 等 POST 不會重送
+    _session.mount("https://", requests.adapters.HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=requests.adapters.Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3),
+    ))
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self._session.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self._session.post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self._session.put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self._session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+
+class _PrecomputedSignatureValidator(SignatureValidator):
+    """
+    X-Line-Signature 驗章：channel secret 固定，HMAC-SHA256 的 key 於啟動時處理一次，
+    每則 webhook 只 copy() 後餵入 body，不再重建 HMAC 物件。
+    """
+
+    def __init__(self, channel_secret):
+        super().__init__(channel_secret)
+        self._hmac = hmac.new(channel_secret.encode("utf-8"), digestmod=hashlib.sha256)
+
+    def validate(self, body, signature):
+        h = self._hmac.copy()
+        h.update(body.encode("utf-8"))
+        return hmac.compare_digest(signature.encode("utf-8"), base64.b64encode(h.digest()))
+
+
 # 1. 初始化
 app = Flask(__name__)
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
+# 各路由只收 LINE webhook 與內部 JSON，過大的 body 直接 413，不讀入記憶體
+app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024
+line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'), http_client=_PooledRequestsHttpClient)
 line_webhook_handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
-# 使用 httpx + RetryTransport 緩解連線瞬斷
+if os.getenv('LINE_CHANNEL_SECRET'):
+    line_webhook_handler.parser.signature_validator = _PrecomputedSignatureValidator(os.getenv('LINE_CHANNEL_SECRET'))
+# 使用 httpx + RetryTransport 緩解連線瞬斷；HTTP/2 多工，連線池放寬以應付語音/文字/TTS 同時爆量
+# （指定 transport 時 Client 的 http2/limits 參數不生效，須設在內層 HTTPTransport）
 _retry = Retry(total=3, backoff_factor=0.5)
 _http_client = httpx.Client(
-    transport=RetryTransport(retry=_retry),
+    transport=RetryTransport(
+        transport=httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        ),
+        retry=_retry,
+    ),
+    timeout=httpx.Timeout(30.0, connect=5.0),
+)
+# 自我呼叫（/api/process-*-async）共用連線池，避免每則訊息重新 TCP+TLS 握手；
+# HTTP/2 讓同一實例的多個背景任務共用一條已握手的連線，連線逾時縮短以免拖住 webhook
+_internal_http = httpx.Client(
+    http2=True,
     limits=httpx.Limits(max_keepalive_connections=5, max_connections=20),
+    timeout=httpx.Timeout(30.0, connect=3.0),
 )
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=_http_client)
 assistant_id = os.getenv("OPENAI_ASSISTANT_ID")
 
 # Redis：Railway 使用 REDIS_URL，標準 redis-py 連線（decode_responses=True 回傳 str）
+# 連線池內的 TCP 連線保持 keepalive；閒置超過 30 秒先 PING 再用，避免被代理切斷的舊連線讓請求失敗重連
 redis = None
 if REDIS_URL:
     try:
@@ -213,6 +285,9 @@ if REDIS_URL:
             REDIS_URL,
             decode_responses=True,
             socket_timeout=5,
+            socket_connect_timeout=3,
+            socket_keepalive=True,
+            health_check_interval=30,
         )
         redis.ping()
         print(">>> SUCCESS: Connected to Railway Redis via REDIS_URL <<<")
@@ -248,12 +323,25 @@ else:
         mongo_client = None
         mongo_db = None
 
-# 模式快取：Redis 瞬斷時使用，key=user_id -> (mode, timestamp)
-_mode_cache = {}
+# 模式快取（LRU）：Redis 瞬斷時使用，key=user_id -> (mode, timestamp)
+_mode_cache = OrderedDict()
 _MODE_CACHE_TTL = 180
 _MODE_CACHE_MAX = 1000
+# Assistant thread 快取（LRU）：key=user_id -> (thread_id, timestamp)，Redis 讀取失敗時沿用，避免每則訊息都開新 thread
+_thread_cache = OrderedDict()
+_THREAD_CACHE_TTL = 1800
+_THREAD_CACHE_MAX = 2048
+# Redis 模式讀寫重試的等待秒數：瞬斷多半在百毫秒內由 redis-py 重連恢復，先短後長，不固定睡滿
+_REDIS_RETRY_DELAYS = (0.05, 0.15, 0.4)
 # 序列化 Redis 存取，避免多 thread 同時呼叫 Upstash 造成 "Device or resource busy"
 _redis_mode_lock = threading.Lock()
+# 回合收尾的並行 fan-out（LINE 送出 / Redis 寫入 / TTS 等彼此獨立的網路呼叫）
+_fanout_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="fanout")
+# 回覆後的長背景工作（MongoDB 記錄、出題、背景文字任務）：重用 worker，不再每則訊息新建 thread；
+# 與 _fanout_pool 分開，避免長任務佔滿 fan-out 或在同池內等待彼此
+_background_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="bg")
+# 背景記錄內的意圖分類（LLM，最長 5 秒）：呼叫端本身在 _background_pool，另開小池以免同池互等或擋住回覆
+_classify_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="classify")
 
 # Cloudinary 設定（TTS 語音檔雲端儲存）
 _cloudinary_configured = bool(
@@ -273,25 +361,80 @@ SAFETY_DISCLAIMER = "\n\n以上資料僅供參考，若有身體不適請務必
 SAFETY_DISCLAIMER_EN = "\n\nThe above information is for reference only. Please seek professional medical advice if you have any health concerns."
 
 USER_LANGUAGE_KEY = "user_language:{user_id}"
+# Assistant run 逾時後保留的 {thread, run, q}：使用者重問同一題時直接取用該 run 的答案
+_PENDING_RUN_KEY = "pending_run:{user_id}"
+_PENDING_RUN_TTL = 600
 
 VOICE_COACH_TTS_VOICE = "shimmer"
 TTS_SPEED = 0.8  # shadowing 語音 0.8 倍速，較慢易於跟讀
 VOICE_ERROR_MSG = "抱歉，語音生成出了一點問題，請再試一次。"
 TIMEOUT_SECONDS = 28  # Assistant + RAG 常需 15–30 秒；保留 buffer 避開 Vercel 預設 30s
 TIMEOUT_MESSAGE = "正在努力翻閱典籍/資料中，請稍候再問我一次。"
+_MIN_RUN_SECONDS = 8  # 同一回合處理完上次逾時的 run 後，剩餘時間不足此值就不再開新 run
 FORCE_PUSH_MODE = os.getenv("LINE_FORCE_PUSH", "true").strip().lower() in ("1", "true", "yes", "on")
 ENABLE_QUIZ_GENERATION = os.getenv("ENABLE_QUIZ_GENERATION", "true").strip().lower() in ("1", "true", "yes", "on")
 # 英文版部署時設 FORCE_LANG=en，強制所有回覆使用英文，不依賴動態語言偵測
 FORCE_LANG = os.getenv("FORCE_LANG", "").strip().lower()  # "en" | "" (空=動態偵測)
 
 # --- 口說練習：糾錯與分析大腦 ---
+_EXACT_CACHE_TTL = 7 * 24 * 3600
+# _evaluate_speech 結構化輸出 schema：模型保證回傳符合欄位與 enum 的 JSON，不必再從文字中擷取
+_SPEECH_EVAL_SCHEMA = {
+    "name": "speech_eval",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "status": {"type": "string", "enum": ["Correct", "NeedsImprovement"]},
+            "feedback": {"type": "string"},
+            "corrected": {"type": "string"},
+        },
+        "required": ["status", "feedback", "corrected"],
+        "additionalProperties": False,
+    },
+}
+
+
+def _exact_cache_key(prefix, *parts):
+    """完全相同輸入的快取 key：prefix:sha1(parts)。"""
+    raw = "\x1f".join(str(p) for p in parts)
+    return f"{prefix}:{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+
+def _exact_cache_get(key, refresh=False):
+    """refresh=True 時以 GETEX 一次完成讀取與續期（常用項目滑動延長 TTL，不多一次往返）。"""
+    if not redis:
+        return None
+    try:
+        val = redis.getex(key, ex=_EXACT_CACHE_TTL) if refresh else redis.get(key)
+        if val is None:
+            return None
+        return json.loads(val)
+    except Exception:
+        return None
+
+
+def _exact_cache_set(key, value):
+    if not redis:
+        return
+    try:
+        redis.set(key, json.dumps(value, ensure_ascii=False), ex=_EXACT_CACHE_TTL)
+    except Exception:
+        pass
+
+
 def _evaluate_speech(transcript):
     """
     糾錯與分析：檢查語法、拼寫、用詞、語義完整性。
     回傳 (status: "Correct"|"NeedsImprovement", feedback_text: str, corrected_text: str 用於 TTS)。
+    相同逐字稿（學生重唸範例句）直接沿用 eval:{sha1} 快取結果。
     """
     if not (transcript or "").strip():
         return "Correct", "", ""
+    cache_key = _exact_cache_key("eval", " ".join(transcript.split()))
+    cached = _exact_cache_get(cache_key)
+    if isinstance(cached, list) and len(cached) == 3:
+        return cached[0], cached[1], cached[2]
     try:
         resp = client.chat.completions.create(
             model="gpt-4o-mini",
@@ -311,27 +454,17 @@ def _evaluate_speech(transcript):
                 {"role": "user", "content": f"Student's speech: {transcript[:500]}"},
             ],
             max_tokens=250,
+            response_format={"type": "json_schema", "json_schema": _SPEECH_EVAL_SCHEMA},
         )
         raw_text = (resp.choices[0].message.content or "").strip()
-        # 嘗試從 code block 或純文字中提取 JSON
-        candidates = []
-        if "```" in raw_text:
-            for seg in raw_text.split("```"):
-                seg = seg.strip().lstrip("json").strip()
-                if seg.startswith("{"):
-                    candidates.append(seg)
-        candidates.append(raw_text)
-        for candidate in candidates:
-            try:
-                obj = json.loads(candidate)
-                status = (obj.get("status") or "Correct").strip()
-                if status not in ("Correct", "NeedsImprovement"):
-                    status = "Correct" if obj.get("correct", True) else "NeedsImprovement"
-                feedback = (obj.get("feedback") or "").strip()[:400]
-                corrected = (obj.get("corrected") or "").strip()[:500]
-                return status, feedback, corrected
-            except Exception:
-                pass
+        if raw_text:
+            obj = json.loads(raw_text)
+            status = obj["status"]
+            feedback = (obj.get("feedback") or "").strip()[:400]
+            corrected = (obj.get("corrected") or "").strip()[:500]
+            _exact_cache_set(cache_key, [status, feedback, corrected])
+            return status, feedback, corrected
+        print("[VOICE] _evaluate_speech empty/refused structured output")
     except Exception:
         traceback.print_exc()
     return "Correct", "", ""
@@ -368,6 +501,15 @@ def _generate_next_practice_sentence(prev_transcript=""):
         return None
 
 
+def _prewarm_practice_tts(sentence):
+    """
+    建議句送出後先在背景產生示範語音：學生照唸時，逐字稿或 corrected 多與建議句相同，
+    下一回合的 _generate_tts_and_store 即可直接命中 tts_url／本機音檔快取。
+    """
+    if sentence and (_cloudinary_configured or not _IS_SERVERLESS):
+        _background_pool.submit(_generate_tts_and_store, sentence, VOICE_COACH_TTS_VOICE)
+
+
 def _upload_tts_to_cloudinary(audio_bytes, sentence=""):
     """上傳 TTS 語音至 Cloudinary（BytesIO 串流、video 資源型別優化音訊），回傳 (secure_url, duration_ms)。"""
     if not _cloudinary_configured or not audio_bytes:
@@ -390,17 +532,107 @@ def _upload_tts_to_cloudinary(audio_bytes, sentence=""):
     return (None, 0)
 
 
+# Cloudinary 未設定時的後備：音檔寫入本機暫存目錄，由 /audio/<token> 直接送出（不經 Redis / base64）
+_TTS_LOCAL_DIR = os.path.join(tempfile.gettempdir(), "tts")
+_TTS_LOCAL_TTL = 600
+_TTS_TOKEN_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+# Serverless（Vercel）各次呼叫不保證落在同一實例，本機暫存檔無法被 /audio 取回
+_IS_SERVERLESS = bool(os.getenv("VERCEL"))
+
+
+# 本 process 的音檔 LRU：/audio 多半由產生音檔的同一 worker 接到，命中時不必讀檔
+_TTS_MEM_MAX = 64
+_tts_mem_cache = OrderedDict()  # token -> (time.monotonic(), mp3 bytes)
+_tts_mem_lock = threading.Lock()
+
+
+def _tts_local_path(token):
+    return os.path.join(_TTS_LOCAL_DIR, f"tts_{token}.mp3")
+
+
+def _tts_mem_put(token, audio_bytes):
+    with _tts_mem_lock:
+        _tts_mem_cache[token] = (time.monotonic(), audio_bytes)
+        _tts_mem_cache.move_to_end(token)
+        while len(_tts_mem_cache) > _TTS_MEM_MAX:
+            _tts_mem_cache.popitem(last=False)
+
+
+def _tts_mem_get(token):
+    with _tts_mem_lock:
+        item = _tts_mem_cache.get(token)
+        if item is None:
+            return None
+        if time.monotonic() - item[0] > _TTS_LOCAL_TTL:
+            del _tts_mem_cache[token]
+            return None
+        _tts_mem_cache.move_to_end(token)
+        return item[1]
+
+
+def _tts_local_fresh(token):
+    """同一 token 的本機後備音檔是否仍可由 /audio/<token> 取得；命中時順延有效期限，避免被清檔。"""
+    data = _tts_mem_get(token)
+    if data is not None:
+        _tts_mem_put(token, data)
+    path = _tts_local_path(token)
+    try:
+        if os.path.getmtime(path) >= time.time() - _TTS_LOCAL_TTL:
+            os.utime(path)
+            return True
+    except OSError:
+        pass
+    return data is not None
+
+
+def _store_tts_locally(token, audio_bytes):
+    """放入記憶體 LRU 並寫入本機暫存音檔（供其他 gunicorn worker 取回），順便清掉超過 _TTS_LOCAL_TTL 的舊檔。成功回傳 True。"""
+    _tts_mem_put(token, audio_bytes)
+    try:
+        os.makedirs(_TTS_LOCAL_DIR, exist_ok=True)
+        cutoff = time.time() - _TTS_LOCAL_TTL
+        for old in glob.glob(os.path.join(_TTS_LOCAL_DIR, "tts_*.mp3")):
+            try:
+                if os.path.getmtime(old) < cutoff:
+                    os.remove(old)
+            except OSError:
+                pass
+        # 先寫同目錄暫存檔再 os.replace：其他 worker 的 /audio 不會讀到寫一半的檔案
+        with tempfile.NamedTemporaryFile(dir=_TTS_LOCAL_DIR, prefix=".tmp_", suffix=".mp3", delete=False) as f:
+            f.write(audio_bytes)
+        os.replace(f.name, _tts_local_path(token))
+        return True
+    except Exception:
+        traceback.print_exc()
+        return False
+
+
 def _generate_tts_and_store(sentence, voice=None):
-    """OpenAI TTS (model: tts-1) 產生語音，直接 BytesIO 串流上傳 Cloudinary，無硬碟寫入。"""
+    """
+    OpenAI TTS (model: tts-1) 產生語音，直接 BytesIO 串流上傳 Cloudinary；未設定 Cloudinary 時才寫本機暫存檔。
+    相同 voice/speed/句子的 Cloudinary 結果快取於 tts_url:{sha1}，命中時略過 TTS 與上傳；
+    本機後備的 token 同樣取自該 sha1，同一句在有效期內重複練習時直接沿用既有音檔。
+    """
     voice = voice or "shimmer"
     if not (sentence or "").strip():
         return (None, 0)
-    token = secrets.token_urlsafe(12)
+    cache_key = _exact_cache_key("tts_url", voice, TTS_SPEED, sentence.strip())
+    cached = _exact_cache_get(cache_key, refresh=True)
+    if isinstance(cached, list) and len(cached) == 2 and cached[0]:
+        return (cached[0], int(cached[1] or 0))
+    if not _cloudinary_configured and _IS_SERVERLESS:
+        # 無 Cloudinary 又在 serverless：後備音檔無從提供，連 TTS 都不必呼叫，由呼叫端改送文字提示
+        print("[TTS] unavailable: Cloudinary not configured on serverless")
+        return (None, 0)
+    token = cache_key.split(":", 1)[1][:32]
     vercel_url = (os.getenv("VERCEL_URL") or "").strip().rstrip("/")
     if vercel_url:
         base_url = f"https://{vercel_url}" if not vercel_url.startswith("http") else vercel_url
     else:
         base_url = (request.host_url.rstrip("/") if request else "") or "https://placeholder.vercel.app"
+    if not _cloudinary_configured and _tts_local_fresh(token):
+        base_dur = max(1000, int(len(sentence.split()) / 2.2 * 1000))
+        return (f"{base_url}/audio/{token}", int(base_dur / TTS_SPEED))
     try:
         resp = client.audio.speech.create(
             model="tts-1",
@@ -416,24 +648,40 @@ def _generate_tts_and_store(sentence, voice=None):
         if _cloudinary_configured:
             cloud_url, cloud_dur = _upload_tts_to_cloudinary(audio_bytes, sentence)
             if cloud_url:
+                # 只快取 Cloudinary 永久網址；本機後備的 /audio/<token> 10 分鐘即清除
+                _exact_cache_set(cache_key, [cloud_url, cloud_dur or duration_ms])
                 return (cloud_url, cloud_dur or duration_ms)
 
-        # 後備：存 Redis，使用 /audio/<token> 路由
-        b64 = base64.b64encode(audio_bytes).decode("ascii")
-        try:
-            if redis:
-                redis.set(f"tts_audio:{token}", b64, ex=600)
-        except Exception:
-            pass
+        # 後備：寫入本機暫存檔，使用 /audio/<token> 路由（serverless 上無法跨實例取回，直接放棄）
+        if _IS_SERVERLESS or not _store_tts_locally(token, audio_bytes):
+            return (None, 0)
         return (f"{base_url}/audio/{token}", duration_ms)
     except Exception:
         traceback.print_exc()
         return (None, 0)
 
 # --- 課務查詢 Flex Message（與本週重點整合）---
-def send_course_inquiry_flex(user_id, reply_token=None):
-    """發送課務查詢 Flex Message（含當週/下週切換、AI 重點、評量、重要日期）。reply_token 有值則 reply，否則 push。"""
-    bubble = build_course_inquiry_flex(client)
+# 課務 bubble 快取：所有使用者共用同一份（含 AI 重點），以台灣日期為 key，跨日即重建；同日最多沿用 1 小時
+_COURSE_FLEX_TTL = 3600
+_course_flex_cache = (0.0, None, None)  # (time.monotonic(), 台灣日期, bubble)
+
+
+def _get_course_inquiry_bubble():
+    global _course_flex_cache
+    ts, day, bubble = _course_flex_cache
+    today = get_now_taipei().date()
+    if bubble is None or day != today or time.monotonic() - ts > _COURSE_FLEX_TTL:
+        bubble = build_course_inquiry_flex(client)
+        _course_flex_cache = (time.monotonic(), today, bubble)
+    return bubble
+
+
+def send_course_inquiry_flex(user_id, reply_token=None, lead_msgs=None):
+    """
+    發送課務查詢 Flex Message（含當週/下週切換、AI 重點、評量、重要日期）。reply_token 有值則 reply，否則 push。
+    lead_msgs：push 時排在 Flex 之前一併送出的訊息（如語音辨識後的提示），與 Flex、回饋合為單次 push。
+    """
+    bubble = _get_course_inquiry_bubble()
     flex_msg = FlexSendMessage(alt_text="📋 課務查詢與本週重點", contents=bubble, quick_reply=quick_reply_items())
     # 與星等回饋併送時，避免「同一個 reply 內多則訊息都帶 quick_reply」造成 LINE API 失敗
     flex_msg_no_qr = FlexSendMessage(alt_text="📋 課務查詢與本週重點", contents=bubble)
@@ -455,6 +703,17 @@ def send_course_inquiry_flex(user_id, reply_token=None):
             except Exception:
                 pass
     else:
+        # 一次 push 送出（提示 +）Flex + 回饋；失敗時退回逐則送出
+        try:
+            line_bot_api.push_message(user_id, list(lead_msgs or []) + [flex_msg_no_qr, feedback_msg])
+            return
+        except Exception as e:
+            print(f">>> DEBUG: send_course_inquiry_flex batched push failed err={e}")
+        if lead_msgs:
+            try:
+                line_bot_api.push_message(user_id, list(lead_msgs))
+            except Exception as e:
+                print(f">>> DEBUG: send_course_inquiry_flex push lead failed err={e}")
         try:
             line_bot_api.push_message(user_id, flex_msg)
         except Exception as e:
@@ -465,21 +724,80 @@ def send_course_inquiry_flex(user_id, reply_token=None):
             print(f">>> DEBUG: send_course_inquiry_flex push feedback failed err={e}")
 
 # --- QuickReply ---
-def quick_reply_items():
-    if FORCE_LANG == "en":
-        return QuickReply(
-            items=[
-                QuickReplyButton(action=MessageAction(label="Speaking Practice", text="Speaking Practice")),
-                QuickReplyButton(action=MessageAction(label="Writing Revision", text="Writing Revision")),
-            ]
-        )
-    return QuickReply(
+# 按鈕組合固定（僅依 FORCE_LANG），模組載入時建立一次，各訊息共用同一實例（序列化時不會被修改）
+if FORCE_LANG == "en":
+    _QR_MAIN = QuickReply(
+        items=[
+            QuickReplyButton(action=MessageAction(label="Speaking Practice", text="Speaking Practice")),
+            QuickReplyButton(action=MessageAction(label="Writing Revision", text="Writing Revision")),
+        ]
+    )
+    _QR_SPEAK = QuickReply(
+        items=[
+            QuickReplyButton(action=MessageAction(label="Next Sentence", text="Next Sentence")),
+            QuickReplyButton(action=MessageAction(label="End Practice", text="End Practice")),
+        ]
+    )
+    _QR_WRITING = QuickReply(
+        items=[
+            QuickReplyButton(action=MessageAction(label="Back to TCM Q&A", text="TCM Q&A")),
+        ]
+    )
+else:
+    _QR_MAIN = QuickReply(
         items=[
             QuickReplyButton(action=MessageAction(label="口說練習", text="口說練習")),
             QuickReplyButton(action=MessageAction(label="寫作修改", text="寫作修改")),
             QuickReplyButton(action=MessageAction(label="課務查詢", text="課務查詢")),
         ]
     )
+    _QR_SPEAK = QuickReply(
+        items=[
+            QuickReplyButton(action=MessageAction(label="練習下一句", text="練習下一句")),
+            QuickReplyButton(action=MessageAction(label="結束練習", text="結束練習")),
+        ]
+    )
+    _QR_WRITING = QuickReply(
+        items=[
+            QuickReplyButton(action=MessageAction(label="回到中醫問答", text="回到中醫問答")),
+        ]
+    )
+_QR_QUIZ = QuickReply(
+    items=[
+        QuickReplyButton(action=MessageAction(label="是", text="是")),
+        QuickReplyButton(action=MessageAction(label="否", text="否")),
+    ]
+)
+_QR_REVIEW = QuickReply(
+    items=[
+        QuickReplyButton(action=MessageAction(label="要", text="要複習筆記")),
+        QuickReplyButton(action=MessageAction(label="不要", text="不要複習筆記")),
+    ]
+)
+_QR_FEEDBACK_STARS = QuickReply(
+    items=[
+        QuickReplyButton(action=PostbackAction(label=f"⭐{n}", data=f"action=feedback&score={n}"))
+        for n in range(1, 6)
+    ]
+)
+_QR_QUIZ_CHOICES = QuickReply(
+    items=[
+        QuickReplyButton(action=PostbackAction(label=f"({c})", data=f"quiz_choice={c}"))
+        for c in ("A", "B", "C")
+    ]
+)
+
+
+# Quick Reply / 作答常見的固定字面值：不可能是課務查詢，handle_message 直接略過意圖判斷
+_QUICK_REPLY_LITERALS = frozenset({
+    "是", "否", "要複習筆記", "不要複習筆記", "複習測驗", "我要複習測驗",
+    "練習下一句", "Next Sentence", "結束練習", "End Practice",
+    "A", "B", "C", "D", "a", "b", "c", "d",
+})
+
+
+def quick_reply_items():
+    return _QR_MAIN
 
 def text_with_quick_reply(content):
     return TextSendMessage(text=content, quick_reply=quick_reply_items())
@@ -490,15 +808,7 @@ _FEEDBACK_ASK_COOLDOWN_SEC = 24 * 3600
 
 
 def quick_reply_feedback_stars():
-    return QuickReply(
-        items=[
-            QuickReplyButton(action=PostbackAction(label="⭐1", data="action=feedback&score=1")),
-            QuickReplyButton(action=PostbackAction(label="⭐2", data="action=feedback&score=2")),
-            QuickReplyButton(action=PostbackAction(label="⭐3", data="action=feedback&score=3")),
-            QuickReplyButton(action=PostbackAction(label="⭐4", data="action=feedback&score=4")),
-            QuickReplyButton(action=PostbackAction(label="⭐5", data="action=feedback&score=5")),
-        ]
-    )
+    return _QR_FEEDBACK_STARS
 
 
 def _should_ask_feedback(user_id):
@@ -511,43 +821,29 @@ def _mark_feedback_asked(user_id):
     return
 
 
+_COURSE_FEEDBACK_MSG = TextSendMessage(
+    text="感謝您的使用！歡迎填寫表單讓我們知道你的意見！https://forms.gle/xUpm5yZSvzEZ6zMh6",
+    quick_reply=_QR_FEEDBACK_STARS,
+)
+
+
 def _build_course_feedback_message():
     """
     課務助教回覆後的回饋訊息（測試用：每次都送）。
     星等用 Quick Reply（postback），表單連結直接放在文字內。
     """
-    return TextSendMessage(
-        text="感謝您的使用！歡迎填寫表單讓我們知道你的意見！https://forms.gle/xUpm5yZSvzEZ6zMh6",
-        quick_reply=quick_reply_feedback_stars(),
-    )
+    return _COURSE_FEEDBACK_MSG
 
 def quick_reply_speak_practice():
     """口說練習：要再練習下一句嗎？[練習下一句] [結束練習]。"""
-    if FORCE_LANG == "en":
-        return QuickReply(
-            items=[
-                QuickReplyButton(action=MessageAction(label="Next Sentence", text="Next Sentence")),
-                QuickReplyButton(action=MessageAction(label="End Practice", text="End Practice")),
-            ]
-        )
-    return QuickReply(
-        items=[
-            QuickReplyButton(action=MessageAction(label="練習下一句", text="練習下一句")),
-            QuickReplyButton(action=MessageAction(label="結束練習", text="結束練習")),
-        ]
-    )
+    return _QR_SPEAK
 
 def text_with_quick_reply_speak_practice(content):
     return TextSendMessage(text=content, quick_reply=quick_reply_speak_practice())
 
 def quick_reply_quiz_ask():
     """每個回答後詢問：要來試試一題小測驗嗎？[是, 否]。"""
-    return QuickReply(
-        items=[
-            QuickReplyButton(action=MessageAction(label="是", text="是")),
-            QuickReplyButton(action=MessageAction(label="否", text="否")),
-        ]
-    )
+    return _QR_QUIZ
 
 def text_with_quick_reply_quiz(content):
     return TextSendMessage(text=content, quick_reply=quick_reply_quiz_ask())
@@ -555,13 +851,12 @@ def text_with_quick_reply_quiz(content):
 
 def quick_reply_quiz_choices():
     """測驗題 A/B/C 選項：以 Postback 送出 quiz_choice=A/B/C，供後端更新 MongoDB quiz_data。"""
-    return QuickReply(
-        items=[
-            QuickReplyButton(action=PostbackAction(label="(A)", data="quiz_choice=A")),
-            QuickReplyButton(action=PostbackAction(label="(B)", data="quiz_choice=B")),
-            QuickReplyButton(action=PostbackAction(label="(C)", data="quiz_choice=C")),
-        ]
-    )
+    return _QR_QUIZ_CHOICES
+
+
+# 測驗 bubble 的固定部分；每次只代入題目文字
+_QUIZ_BUBBLE_TITLE = {"type": "text", "text": "📝 一題小測驗", "weight": "bold", "size": "lg"}
+_QUIZ_BUBBLE_BODY = {"type": "box", "layout": "vertical", "spacing": "md"}
 
 
 def build_quiz_flex_message(question):
@@ -569,11 +864,9 @@ def build_quiz_flex_message(question):
     bubble = {
         "type": "bubble",
         "body": {
-            "type": "box",
-            "layout": "vertical",
-            "spacing": "md",
+            **_QUIZ_BUBBLE_BODY,
             "contents": [
-                {"type": "text", "text": "📝 一題小測驗", "weight": "bold", "size": "lg"},
+                _QUIZ_BUBBLE_TITLE,
                 {"type": "text", "text": question, "wrap": True, "size": "sm"},
             ],
         },
@@ -707,12 +1000,7 @@ def time_locked_quiz_handler(user_id, reply_token=None):
 
 def quick_reply_review_ask():
     """主動複習：需要幫你整理複習筆記嗎？[要, 不要]。"""
-    return QuickReply(
-        items=[
-            QuickReplyButton(action=MessageAction(label="要", text="要複習筆記")),
-            QuickReplyButton(action=MessageAction(label="不要", text="不要複習筆記")),
-        ]
-    )
+    return _QR_REVIEW
 
 def text_with_quick_reply_review_ask(content):
     return TextSendMessage(text=content, quick_reply=quick_reply_review_ask())
@@ -721,6 +1009,9 @@ def text_with_quick_reply_review_ask(content):
 REVISION_MODE = "writing"
 REVISION_MODE_PROMPT = "你已在【✍️ 寫作修訂】模式～請貼上要修改的段落。"
 REDIS_KEY_USER_MODE = "user_mode"  # 與 Postback/切換按鈕寫入的 Key 完全一致：user_mode:{user_id}
+# 模式顯示名稱：切換確認、分析中提示與 Assistant 訊息標籤共用，不在各 handler 內重建
+MODE_LABELS = {"tcm": "🩺 中醫問答", "speaking": "🗣️ 口說練習", REVISION_MODE: "✍️ 寫作修訂"}
+MODE_LABELS_EN = {"tcm": "🩺 TCM Q&A", "speaking": "🗣️ Speaking Practice", REVISION_MODE: "✍️ Writing Revision"}
 
 # 寫作模式 prompt：回饋需含下列內容，但不要輸出標題給使用者
 _REVISION_PROMPT = (
@@ -746,7 +1037,8 @@ _REVISION_PROMPT_EN = (
 
 def _revision_handler(user_id, text):
     """
-    寫作修訂：gpt-4o-mini + Chat Completion，非串流以加速。結果以 push_message 送出。
+    寫作修訂：gpt-4o-mini + Chat Completion（串流接收，超過 TIMEOUT_SECONDS 即以已收到的內容送出）。
+    結果以 push_message 送出。
     """
     if not user_id or not str(user_id).strip():
         print(f"[REVISION] ERROR: user_id invalid or empty user_id={repr(user_id)}")
@@ -772,15 +1064,25 @@ def _revision_handler(user_id, text):
         else:
             revision_system = _REVISION_PROMPT
             revision_user = f"分析以下句子或段落：\n{text[:1000]}"
-        resp = client.chat.completions.create(
+        stream = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": revision_system},
                 {"role": "user", "content": revision_user},
             ],
             max_tokens=600,
+            stream=True,
         )
-        reply = (resp.choices[0].message.content or "").strip()
+        deadline = time.monotonic() + TIMEOUT_SECONDS
+        parts = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+            if time.monotonic() > deadline:
+                print(f"[REVISION] stream timeout user_id={user_id}, sending partial reply")
+                stream.close()
+                break
+        reply = "".join(parts).strip()
         if not reply:
             reply = "已收到你的練習！歡迎繼續貼上其他句子～"
         print(f"[REVISION] done user_id={user_id} reply_len={len(reply)}")
@@ -803,17 +1105,7 @@ def _revision_handler(user_id, text):
 
 def quick_reply_writing():
     """寫作修訂模式：回到中醫問答按鈕。"""
-    if FORCE_LANG == "en":
-        return QuickReply(
-            items=[
-                QuickReplyButton(action=MessageAction(label="Back to TCM Q&A", text="TCM Q&A")),
-            ]
-        )
-    return QuickReply(
-        items=[
-            QuickReplyButton(action=MessageAction(label="回到中醫問答", text="回到中醫問答")),
-        ]
-    )
+    return _QR_WRITING
 
 def text_with_quick_reply_writing(content):
     return TextSendMessage(text=content, quick_reply=quick_reply_writing())
@@ -826,6 +1118,7 @@ def _redis_user_mode_key(user_id):
 _DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
 _TCM_JSON_CACHE = None
 _TCM_FULL_CONTEXT_CACHE = None
+_TCM_KP_INDEX_CACHE = None
 
 def _load_tcm_json():
     """載入 data/tcm_master_knowledge.json，快取。"""
@@ -979,13 +1272,16 @@ def _ensure_sources_section(text: str, english: bool = False) -> str:
         return t + "\n\n資料來源：無（資料庫未收錄/不足以支持）"
 
 
+_LATIN_RE = re.compile(r"[A-Za-z]")
+_CJK_RE = re.compile(r"[\u4e00-\u9fff\u3400-\u4dbf\uF900-\uFAFF]")
+
+
 def _is_english_input(text: str) -> bool:
     t = (text or "").strip()
     if not t:
         return False
-    has_latin = bool(re.search(r"[A-Za-z]", t))
-    has_cjk = bool(re.search(r"[\u4e00-\u9fff\u3400-\u4dbf\uF900-\uFAFF]", t))
-    return has_latin and not has_cjk
+    # 先查 CJK：中文訊息為多數，命中即可略過 Latin 掃描
+    return not _CJK_RE.search(t) and bool(_LATIN_RE.search(t))
 
 
 def _set_user_language(user_id, lang):
@@ -1004,25 +1300,90 @@ def _get_user_language(user_id):
         val = redis.get(USER_LANGUAGE_KEY.format(user_id=user_id))
         if val is None:
             return "zh"
-        if isinstance(val, bytes):
-            val = val.decode("utf-8", errors="replace")
-        return str(val or "zh").strip().lower() or "zh"
+        return val.strip().lower() or "zh"
     except Exception:
         return "zh"
 
 
+def _review_note_cached(category):
+    """
+    複習筆記只取決於領域，跨使用者共用 review_note:{sha1} 快取；
+    generate_review_note 失敗時回傳的預設文字不寫入快取。
+    """
+    key = _exact_cache_key("review_note", category)
+    note = _exact_cache_get(key)
+    if isinstance(note, str) and note:
+        return note
+    note = generate_review_note(client, category)
+    if note and note != f"【{category}】複習要點請參考課本與講義。":
+        _exact_cache_set(key, note)
+    return note
+
+
+# 進行中的筆記預熱：category -> Future，使用者按下「要複習筆記」時等它完成，不重複生成
+_review_note_inflight = {}
+_review_note_lock = threading.Lock()
+_REVIEW_NOTE_WAIT_SECONDS = 20  # 須在 LINE reply token 失效前回覆
+
+
+def _prewarm_review_note(category):
+    """背景預先產生複習筆記；同一領域已有進行中的生成時不再重送。"""
+    with _review_note_lock:
+        if category in _review_note_inflight:
+            return
+        fut = _background_pool.submit(_review_note_cached, category)
+        _review_note_inflight[category] = fut
+
+    def _done(f, category=category):
+        with _review_note_lock:
+            if _review_note_inflight.get(category) is f:
+                _review_note_inflight.pop(category, None)
+
+    fut.add_done_callback(_done)
+
+
+def _get_review_note(category):
+    """取筆記：若預熱仍在進行則有限時間等待其結果，逾時或失敗才改為當場生成。"""
+    with _review_note_lock:
+        fut = _review_note_inflight.get(category)
+    if fut is not None:
+        try:
+            note = fut.result(timeout=_REVIEW_NOTE_WAIT_SECONDS)
+            if note:
+                return note
+        except Exception as e:
+            print(f"[REVIEW] prewarmed note unavailable category={category} err={e}")
+    return _review_note_cached(category)
+
+
 def _maybe_send_review_prompt(user_id, reply_token=None):
-    weak = get_weak_categories(redis, user_id, min_count=2)
+    # 每次中醫問答後都會呼叫：弱項與上次詢問時間一次 pipeline 讀取，寫入也合併送出
+    weak, last_ask = get_review_ask_state(redis, user_id, min_count=2)
     if not weak:
         return False
-    if (time.time() - get_last_review_ask(redis, user_id)) <= 7 * 24 * 3600:
+    if (time.time() - last_ask) <= 7 * 24 * 3600:
         return False
     category = next(iter(weak.keys()), None)
     if not category:
         return False
-    set_last_review_ask(redis, user_id)
-    set_pending_review_category(redis, user_id, category)
-    user_lang = "en" if FORCE_LANG == "en" else _get_user_language(user_id)
+    if redis:
+        try:
+            p = redis.pipeline(transaction=False)
+            set_last_review_ask(p, user_id)
+            set_pending_review_category(p, user_id, category)
+            p.get(USER_LANGUAGE_KEY.format(user_id=user_id))
+            user_lang = (_decode_redis_str(p.execute()[-1]) or "zh").lower()
+        except Exception as e:
+            print(f"[REVIEW] review-ask state write failed err={e}")
+            user_lang = None
+    else:
+        user_lang = None
+    if FORCE_LANG == "en":
+        user_lang = "en"
+    elif not user_lang:
+        user_lang = _get_user_language(user_id)
+    # 預先在背景產生筆記：使用者點「要複習筆記」時直接命中快取，不必再等一次生成
+    _prewarm_review_note(category)
     if user_lang == "en":
         review_msg = text_with_quick_reply_review_ask(f"I noticed you are less confident with '{category}'. Would you like a review note?")
     else:
@@ -1054,7 +1415,8 @@ def _start_loading_indicator(user_id, loading_seconds=20):
     if not token or not user_id:
         return
     try:
-        requests.post(
+        # 與 LINE SDK 共用同一個 Session，沿用既有 keep-alive 連線
+        _PooledRequestsHttpClient._session.post(
             "https://api.line.me/v2/bot/chat/loading/start",
             json={"chatId": user_id, "loadingSeconds": loading_seconds},
             headers={
@@ -1074,6 +1436,8 @@ def _log_interaction_to_mongodb_async(user_id, text, ai_reply, is_eng):
     if mongo_db is None:
         print(">>> LOGGING ERROR: db instance is None, skipping async logging")
         return
+    # 意圖分類（LLM）與下方 LINE profile、Mongo 讀寫互不相依，先丟出並行執行
+    intent_future = _classify_pool.submit(classify_qa_intent_and_complexity, client, text)
     try:
         # 取得 LINE 使用者名稱
         user_name = None
@@ -1105,7 +1469,7 @@ def _log_interaction_to_mongodb_async(user_id, text, ai_reply, is_eng):
             now_utc = datetime.now(timezone.utc)
             session_duration_sec = (now_utc - last_ts).total_seconds() if last_ts else 0
             follow_up = get_follow_up_count_within_sec(mongo_db, user_id, within_sec=1800)
-            intent_tag, complexity_score = classify_qa_intent_and_complexity(client, text)
+            intent_tag, complexity_score = intent_future.result()
             interaction_id = log_interaction(
                 mongo_db,
                 user_id,
@@ -1131,25 +1495,16 @@ def _log_interaction_to_mongodb_async(user_id, text, ai_reply, is_eng):
         print(f">>> MONGODB ERROR: Failed to log message: {e}")
 
 
-def _tcm_openai_reply(user_id, text, reply_token=None):
+def _tcm_kp_index():
     """
-    以 tcm_master_knowledge.json 為 context，用 OpenAI gpt-4o-mini 生成回覆。
-    先關鍵字匹配，有匹配用精簡 context；無匹配用完整 JSON。不經過 Assistant API。
-    回傳 True 若已回覆，False 若失敗。
-    優先使用 reply_token 以避免 push 額度限制。
+    知識點索引（快取）：每個 knowledge point 的關鍵詞編成單一 regex，並預先組好命中時要加入 context 的文字。
+    關鍵詞與 context 只取決於 JSON 內容，每個 process 組一次；查詢時每個知識點只做一次 regex search。
     """
-    if not (text or "").strip():
-        return False
-    import time
-
-    txt = text.strip()
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        return False
-    start_ts = time.time()
-    all_data = _load_tcm_json()
-    ctx_parts = []
-    for data in all_data:
+    global _TCM_KP_INDEX_CACHE
+    if _TCM_KP_INDEX_CACHE is not None:
+        return _TCM_KP_INDEX_CACHE
+    index = []
+    for data in _load_tcm_json():
         for kp in data.get("knowledge_points") or []:
             cat = (kp.get("category") or "").split("(")[0].strip()
             terms = [cat] if len(cat) >= 2 else []
@@ -1229,67 +1584,93 @@ def _tcm_openai_reply(user_id, text, reply_token=None):
                     v = cp.get("pulse", "").split("(")[0].strip()
                     if len(v) >= 2:
                         terms.append(v)
-            if any(t in txt for t in terms if t and len(t) >= 2):
-                if kp.get("core_logic"):
-                    ctx_parts.append(kp["core_logic"])
-                if kp.get("mechanism"):
-                    ctx_parts.append(kp["mechanism"])
-                cr = kp.get("causal_relationships")
-                if cr:
-                    lines = [f"{r.get('emotion','')}→{r.get('impact','')}：{r.get('symptoms','')}" for r in cr if isinstance(r, dict)]
-                    ctx_parts.append("；".join(lines))
-                for row in (kp.get("five_elements_table") or []):
-                    if isinstance(row, dict):
-                        ctx_parts.append(json.dumps(row, ensure_ascii=False))
-                if kp.get("interactions"):
-                    for k, v in (kp["interactions"] or {}).items():
-                        ctx_parts.append(f"{k}: {v}")
-                pf = kp.get("pathological_features")
-                if pf:
-                    lines = [f"{r.get('evil','')}：{r.get('features','')}" for r in pf if isinstance(r, dict)]
-                    ctx_parts.append("；".join(lines))
-                for qa in (kp.get("student_qa") or []):
-                    if isinstance(qa, str):
-                        ctx_parts.append(qa)
-                for ii in (kp.get("inspection_items") or []):
-                    if isinstance(ii, dict):
-                        ctx_parts.append(ii.get("item", "") + ": " + (ii.get("logic") or ", ".join(ii.get("types", []))))
-                if kp.get("mapping"):
-                    for k, v in (kp["mapping"] or {}).items():
-                        ctx_parts.append(f"{k}: {v}")
-                for feat in (kp.get("features") or []):
-                    if isinstance(feat, dict):
-                        ctx_parts.append(feat.get("type", "") + ": " + (feat.get("logic") or ""))
-                        for d in (feat.get("details") or []):
-                            if isinstance(d, dict):
-                                ctx_parts.append(json.dumps(d, ensure_ascii=False))
-                for item in (kp.get("items") or []):
-                    if isinstance(item, dict):
-                        ctx_parts.append(f"{item.get('name','')}: {item.get('logic','')}")
-                for d in (kp.get("details") or []):
-                    if isinstance(d, dict):
-                        label = d.get("type") or d.get("item", "")
-                        ctx_parts.append(f"{label}: {d.get('logic','')}")
-                for t in (kp.get("types") or []):
-                    if isinstance(t, dict):
-                        ctx_parts.append(f"{t.get('name','')}: {t.get('logic','')}")
-                if kp.get("functions"):
-                    ctx_parts.append(kp["functions"])
-                for m in (kp.get("methods") or []):
-                    if isinstance(m, dict):
-                        ctx_parts.append(f"{m.get('name','')}: {m.get('details','')}")
-                for cc in (kp.get("common_conditions") or []):
-                    if isinstance(cc, str):
-                        ctx_parts.append(cc)
-                for tq in (kp.get("ten_questions_logic") or []):
-                    if isinstance(tq, dict):
-                        ctx_parts.append(f"{tq.get('item','')}: {tq.get('logic','')}")
-                if kp.get("pulse_mapping"):
-                    for k, v in (kp["pulse_mapping"] or {}).items():
-                        ctx_parts.append(f"{k}: {v}")
-                for cp in (kp.get("common_pulses") or []):
-                    if isinstance(cp, dict):
-                        ctx_parts.append(f"{cp.get('pulse','')}: {cp.get('logic','')}")
+            kp_parts = []
+            if kp.get("core_logic"):
+                kp_parts.append(kp["core_logic"])
+            if kp.get("mechanism"):
+                kp_parts.append(kp["mechanism"])
+            cr = kp.get("causal_relationships")
+            if cr:
+                lines = [f"{r.get('emotion','')}→{r.get('impact','')}：{r.get('symptoms','')}" for r in cr if isinstance(r, dict)]
+                kp_parts.append("；".join(lines))
+            for row in (kp.get("five_elements_table") or []):
+                if isinstance(row, dict):
+                    kp_parts.append(json.dumps(row, ensure_ascii=False))
+            if kp.get("interactions"):
+                for k, v in (kp["interactions"] or {}).items():
+                    kp_parts.append(f"{k}: {v}")
+            pf = kp.get("pathological_features")
+            if pf:
+                lines = [f"{r.get('evil','')}：{r.get('features','')}" for r in pf if isinstance(r, dict)]
+                kp_parts.append("；".join(lines))
+            for qa in (kp.get("student_qa") or []):
+                if isinstance(qa, str):
+                    kp_parts.append(qa)
+            for ii in (kp.get("inspection_items") or []):
+                if isinstance(ii, dict):
+                    kp_parts.append(ii.get("item", "") + ": " + (ii.get("logic") or ", ".join(ii.get("types", []))))
+            if kp.get("mapping"):
+                for k, v in (kp["mapping"] or {}).items():
+                    kp_parts.append(f"{k}: {v}")
+            for feat in (kp.get("features") or []):
+                if isinstance(feat, dict):
+                    kp_parts.append(feat.get("type", "") + ": " + (feat.get("logic") or ""))
+                    for d in (feat.get("details") or []):
+                        if isinstance(d, dict):
+                            kp_parts.append(json.dumps(d, ensure_ascii=False))
+            for item in (kp.get("items") or []):
+                if isinstance(item, dict):
+                    kp_parts.append(f"{item.get('name','')}: {item.get('logic','')}")
+            for d in (kp.get("details") or []):
+                if isinstance(d, dict):
+                    label = d.get("type") or d.get("item", "")
+                    kp_parts.append(f"{label}: {d.get('logic','')}")
+            for t in (kp.get("types") or []):
+                if isinstance(t, dict):
+                    kp_parts.append(f"{t.get('name','')}: {t.get('logic','')}")
+            if kp.get("functions"):
+                kp_parts.append(kp["functions"])
+            for m in (kp.get("methods") or []):
+                if isinstance(m, dict):
+                    kp_parts.append(f"{m.get('name','')}: {m.get('details','')}")
+            for cc in (kp.get("common_conditions") or []):
+                if isinstance(cc, str):
+                    kp_parts.append(cc)
+            for tq in (kp.get("ten_questions_logic") or []):
+                if isinstance(tq, dict):
+                    kp_parts.append(f"{tq.get('item','')}: {tq.get('logic','')}")
+            if kp.get("pulse_mapping"):
+                for k, v in (kp["pulse_mapping"] or {}).items():
+                    kp_parts.append(f"{k}: {v}")
+            for cp in (kp.get("common_pulses") or []):
+                if isinstance(cp, dict):
+                    kp_parts.append(f"{cp.get('pulse','')}: {cp.get('logic','')}")
+            words = sorted({t for t in terms if t and len(t) >= 2}, key=len, reverse=True)
+            rx = re.compile("|".join(map(re.escape, words))) if words else None
+            index.append((rx, kp_parts))
+    _TCM_KP_INDEX_CACHE = index
+    return index
+
+
+def _tcm_openai_reply(user_id, text, reply_token=None, loading=None):
+    """
+    以 tcm_master_knowledge.json 為 context，用 OpenAI gpt-4o-mini 生成回覆。
+    先關鍵字匹配，有匹配用精簡 context；無匹配用完整 JSON。不經過 Assistant API。
+    回傳 True 若已回覆，False 若失敗。
+    優先使用 reply_token 以避免 push 額度限制。
+    loading 為背景送出的載入動畫 future：回覆前先等它完成，避免動畫在答案之後才出現。
+    """
+    if not (text or "").strip():
+        return False
+
+    txt = text.strip()
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return False
+    ctx_parts = []
+    for rx, kp_parts in _tcm_kp_index():
+        if rx is not None and rx.search(txt):
+            ctx_parts.extend(kp_parts)
     ctx = "\n".join(ctx_parts)[:2000] if ctx_parts else _build_full_tcm_context()[:4000]
     if not ctx or not ctx.strip():
         return False
@@ -1329,13 +1710,21 @@ def _tcm_openai_reply(user_id, text, reply_token=None):
 
         messages.append({"role": "user", "content": user_question})
 
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=800,
-            temperature=0.2,
-        )
-        base_reply = (resp.choices[0].message.content or "").strip()[:800]
+        # 語意快取：僅首問（無對話歷史）才查，追問依賴上下文不適合共用回覆
+        cache_mode = "tcm:en" if is_eng else "tcm:zh"
+        cached_reply, cache_emb = (None, None)
+        if not history:
+            cached_reply, cache_emb = semcache_lookup(redis, client, txt, cache_mode)
+        if cached_reply:
+            base_reply = cached_reply
+        else:
+            resp = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                max_tokens=800,
+                temperature=0.2,
+            )
+            base_reply = (resp.choices[0].message.content or "").strip()[:800]
         # 社交短句判斷：GPT 回應很短且不含資料來源標記，視為社交回應，不補 disclaimer
         _is_social_reply = len(base_reply) < 120 and "資料來源" not in base_reply and "Sources" not in base_reply
         if _is_social_reply:
@@ -1343,39 +1732,33 @@ def _tcm_openai_reply(user_id, text, reply_token=None):
         else:
             base_reply = _ensure_sources_section(base_reply, english=is_eng)
             ai_reply = base_reply + disclaimer
+            if not history and not cached_reply:
+                _background_pool.submit(semcache_store, redis, client, txt, cache_mode, base_reply, cache_emb)
 
         # MongoDB 寫入改為背景非同步（不阻塞答復流程）
-        threading.Thread(
-            target=_log_interaction_to_mongodb_async,
-            args=(user_id, text, ai_reply, is_eng),
-            daemon=True,
-        ).start()
+        _background_pool.submit(_log_interaction_to_mongodb_async, user_id, text, ai_reply, is_eng)
 
         # QA → Quiz：社交短句不出題
         if ENABLE_QUIZ_GENERATION and not _is_social_reply:
-            threading.Thread(target=_process_quiz_sync, args=(user_id, base_reply, "en" if is_eng else "zh"), daemon=True).start()
+            _background_pool.submit(_process_quiz_sync, user_id, base_reply, "en" if is_eng else "zh")
 
         # 回覆：只回覆答案（無測驗訊息），根據 FORCE_PUSH_MODE 決定是否 push。
         ai_msg = text_with_quick_reply(ai_reply)
-        try:
-            if FORCE_PUSH_MODE:
-                line_bot_api.push_message(user_id, ai_msg)
-            elif reply_token:
-                line_bot_api.reply_message(reply_token, ai_msg)
-            else:
-                line_bot_api.push_message(user_id, ai_msg)
-        except Exception as e:
-            print(f">>> DEBUG: tcm reply/push failed err={e}")
 
-        try:
-            # 設定使用者語言偏好（reply 之後，不在 critical path）
-            _set_user_language(user_id, "en" if is_eng else "zh")
-            log_question(redis, user_id, text)
-            set_last_question(redis, user_id, text)
-            set_last_assistant_message(redis, user_id, ai_reply)
-            append_conv_history(redis, user_id, txt, base_reply)
-        except Exception:
-            pass
+        def _send():
+            _wait_quietly(loading)
+            try:
+                if FORCE_PUSH_MODE:
+                    line_bot_api.push_message(user_id, ai_msg)
+                elif reply_token:
+                    line_bot_api.reply_message(reply_token, ai_msg)
+                else:
+                    line_bot_api.push_message(user_id, ai_msg)
+            except Exception as e:
+                print(f">>> DEBUG: tcm reply/push failed err={e}")
+
+        # 回覆與語言偏好／問答記錄（一次 pipeline）並行送出
+        _finalize_turn(user_id, text, ai_reply, _send, conv=(txt, base_reply), lang="en" if is_eng else "zh")
 
         return True
     except Exception:
@@ -1383,28 +1766,117 @@ def _tcm_openai_reply(user_id, text, reply_token=None):
         return False
 
 def _get_cached_mode(user_id):
-    """Redis 失敗時從本地快取讀取最近一次成功的模式。"""
-    now = time.time()
-    if user_id in _mode_cache:
-        mode, ts = _mode_cache[user_id]
-        if now - ts < _MODE_CACHE_TTL:
-            return mode
-        try:
-            del _mode_cache[user_id]
-        except KeyError:
-            pass
+    """Redis 失敗時從本地快取讀取最近一次成功的模式。TTL 以 monotonic 計時，不受系統時鐘調整影響。"""
+    hit = _mode_cache.get(user_id)
+    if not hit:
+        return None
+    mode, ts = hit
+    if time.monotonic() - ts < _MODE_CACHE_TTL:
+        return mode
+    _mode_cache.pop(user_id, None)
     return None
 
 def _set_cached_mode(user_id, mode):
     """寫入模式快取，供 Redis 瞬斷時 fallback。"""
-    now = time.time()
-    while len(_mode_cache) >= _MODE_CACHE_MAX:
+    _mode_cache[user_id] = (mode, time.monotonic())
+    _mode_cache.move_to_end(user_id)
+    # 依寫入順序淘汰最舊者，O(1)，不再每次掃描整個快取找最小 timestamp
+    while len(_mode_cache) > _MODE_CACHE_MAX:
         try:
-            oldest = min(_mode_cache.items(), key=lambda x: x[1][1])
-            del _mode_cache[oldest[0]]
-        except (ValueError, KeyError):
+            _mode_cache.popitem(last=False)
+        except KeyError:
             break
-    _mode_cache[user_id] = (mode, now)
+
+def _get_cached_thread(user_id):
+    """Redis 未提供 thread 時，從本地 LRU 取最近一次已知的 thread id。"""
+    hit = _thread_cache.get(user_id)
+    if not hit:
+        return None
+    thread_id, ts = hit
+    if time.monotonic() - ts >= _THREAD_CACHE_TTL:
+        _thread_cache.pop(user_id, None)
+        return None
+    return thread_id
+
+def _set_cached_thread(user_id, thread_id):
+    """記下使用者的 thread id（讀到或新建時），超過上限淘汰最久未用者。"""
+    if not user_id or not thread_id:
+        return
+    _thread_cache[user_id] = (thread_id, time.monotonic())
+    _thread_cache.move_to_end(user_id)
+    while len(_thread_cache) > _THREAD_CACHE_MAX:
+        try:
+            _thread_cache.popitem(last=False)
+        except KeyError:
+            break
+
+def _set_mode(user_id, mode, ex=86400, retries=1):
+    """
+    寫入使用者模式：先更新本地快取，再寫 Redis（失敗時最多重試 retries 次）。
+    所有 user_mode 寫入都應經過這裡，避免本地快取與 Redis 不一致。回傳 Redis 是否寫入成功。
+    """
+    _set_cached_mode(user_id, mode)
+    if not redis:
+        return False
+    for attempt in range(retries):
+        try:
+            with _redis_mode_lock:
+                redis.set(_redis_user_mode_key(user_id), mode, ex=ex)
+            return True
+        except Exception as e:
+            print(f"[MODE] _set_mode user_id={user_id} mode={mode} attempt={attempt} err={e}")
+            if attempt < retries - 1:
+                time.sleep(_REDIS_RETRY_DELAYS[min(attempt, len(_REDIS_RETRY_DELAYS) - 1)])
+    return False
+
+def _write_quiz_state(user_id, quiz, category="其他", quiz_type="Immediate"):
+    """
+    出題：state、mode、題目資料、pending 與 quiz_sent_at 以單一 pipeline 寫入（一次 RTT），
+    於送出題目前同步完成，使用者作答時狀態必已就緒。回傳 quiz_id。
+    """
+    quiz_id = secrets.token_hex(8)
+    _set_cached_mode(user_id, "quiz")
+    if not redis:
+        return quiz_id
+    try:
+        p = redis.pipeline(transaction=False)
+        p.set(f"user_state:{user_id}", STATE_QUIZ_WAITING, ex=3600)
+        p.set(_redis_user_mode_key(user_id), "quiz", ex=3600)
+        set_mcq_quiz_data(
+            p,
+            user_id,
+            quiz.get("question", ""),
+            quiz.get("options", []),
+            quiz.get("answer", ""),
+            quiz.get("explanation", ""),
+            category=category,
+            quiz_id=quiz_id,
+            quiz_type=quiz_type,
+        )
+        set_quiz_pending(p, user_id, quiz.get("question", ""))
+        p.set(f"quiz_sent_at:{user_id}", str(time.time()), ex=3600)
+        with _redis_mode_lock:
+            p.execute()
+    except Exception as e:
+        print(f"[QUIZ] _write_quiz_state user_id={user_id} err={e}")
+    return quiz_id
+
+def _clear_quiz_state(user_id):
+    """作答完成或跳過：清除測驗相關 key 並將 state / mode 復原為一般，合併為單一 pipeline。"""
+    _set_cached_mode(user_id, "tcm")
+    if not redis:
+        return
+    try:
+        p = redis.pipeline(transaction=False)
+        p.delete(f"quiz_sent_at:{user_id}", f"quiz_interaction_id:{user_id}")
+        set_user_state(p, user_id, STATE_NORMAL)
+        p.set(_redis_user_mode_key(user_id), "tcm", ex=86400)
+        clear_quiz_data(p, user_id)
+        clear_quiz_pending(p, user_id)
+        with _redis_mode_lock:
+            p.execute()
+    except Exception as e:
+        print(f"[QUIZ] _clear_quiz_state user_id={user_id} err={e}")
 
 def _safe_get_mode(user_id):
     """
@@ -1431,7 +1903,7 @@ def _safe_get_mode(user_id):
             except Exception as e:
                 last_err = e
                 if attempt < 2:
-                    time.sleep(0.3 * (attempt + 1))
+                    time.sleep(_REDIS_RETRY_DELAYS[attempt])
                     continue
                 # Redis 重試後仍失敗：嘗試快取
                 cached = _get_cached_mode(user_id)
@@ -1454,10 +1926,7 @@ def _safe_get_mode(user_id):
             print(f"[MODE] _safe_get_mode user_id={user_id} fallback=tcm reason=key_missing_or_null")
             print(f"DEBUG: Fetching mode for {user_id}. Result: tcm")
             return "tcm"
-        if isinstance(mode_val, bytes):
-            mode_str = mode_val.decode("utf-8", errors="replace").strip()
-        else:
-            mode_str = str(mode_val).strip()
+        mode_str = str(mode_val).strip()
         if not mode_str:
             cached = _get_cached_mode(user_id)
             if cached:
@@ -1480,79 +1949,329 @@ def _safe_get_mode(user_id):
         print(f"DEBUG: Fetching mode for {user_id}. Result: tcm")
         return "tcm"
 
+
+def _decode_redis_str(val):
+    """Redis 回傳值（decode_responses=True，已是 str）去空白；None 或空字串回傳 None。"""
+    if val is None:
+        return None
+    return str(val).strip() or None
+
+
+def _load_user_ctx(user_id):
+    """
+    以單一 pipeline 讀取本回合所需的使用者狀態（mode / state / thread / lang / pending_run），
+    取代分散在 handler 各處的多次 redis.get。Redis 不可用或失敗時各欄位為 None，由呼叫端 fallback。
+    """
+    ctx = {"mode": None, "state": None, "thread": None, "lang": None, "pending_run": None}
+    if not redis or not user_id:
+        return ctx
+    try:
+        p = redis.pipeline(transaction=False)
+        p.get(_redis_user_mode_key(user_id))
+        p.get(f"user_state:{user_id}")
+        p.get(f"user_thread:{user_id}")
+        p.get(USER_LANGUAGE_KEY.format(user_id=user_id))
+        p.get(_PENDING_RUN_KEY.format(user_id=user_id))
+        with _redis_mode_lock:
+            mode_v, state_v, thread_v, lang_v, pending_v = p.execute()
+    except Exception as e:
+        print(f"[CTX] _load_user_ctx user_id={user_id} failed err={e}")
+        return ctx
+    mode = _decode_redis_str(mode_v)
+    if mode:
+        ctx["mode"] = mode.lower()
+        _set_cached_mode(user_id, ctx["mode"])
+    ctx["state"] = _decode_redis_str(state_v) or STATE_NORMAL
+    thread_id = _decode_redis_str(thread_v)
+    ctx["thread"] = thread_id if thread_id and thread_id != "None" else None
+    if ctx["thread"]:
+        _set_cached_thread(user_id, ctx["thread"])
+    ctx["lang"] = (_decode_redis_str(lang_v) or "zh").lower()
+    ctx["pending_run"] = _decode_redis_str(pending_v)
+    return ctx
+
+
+def _ctx_mode(user_id, ctx):
+    """優先使用 ctx 內已讀取的 mode，缺值時退回 _safe_get_mode（含本地快取 fallback）。"""
+    return (ctx or {}).get("mode") or _safe_get_mode(user_id)
+
+
+def _persist_turn(user_id, text, ai_reply, conv=None, lang=None, thread_id=None):
+    """回覆後的 Redis 寫入（thread、語言、提問記錄、最後問答、對話歷史）合併為一次 pipeline 送出。"""
+    if not redis:
+        return
+    try:
+        p = redis.pipeline(transaction=False)
+        if thread_id:
+            p.set(f"user_thread:{user_id}", thread_id)
+        if lang:
+            p.set(USER_LANGUAGE_KEY.format(user_id=user_id), lang, ex=7 * 24 * 3600)
+        log_question(p, user_id, text)
+        set_last_question(p, user_id, text)
+        set_last_assistant_message(p, user_id, ai_reply)
+        if conv:
+            append_conv_history(p, user_id, conv[0], conv[1])
+        p.execute()
+    except Exception as e:
+        print(f"[CTX] _persist_turn user_id={user_id} failed err={e}")
+
+
+def _finalize_turn(user_id, text, ai_reply, send_fn, conv=None, lang=None, thread_id=None):
+    """
+    回合收尾：send_fn（LINE reply/push）與 _persist_turn 彼此獨立，並行送出，
+    總耗時約等於較慢的一方。兩者各自處理例外，這裡只等待完成。
+    thread_id 為本回合新建的 Assistant thread，隨同一個 pipeline 寫回。
+    """
+    futures = [
+        _fanout_pool.submit(send_fn),
+        _fanout_pool.submit(_persist_turn, user_id, text, ai_reply, conv, lang, thread_id),
+    ]
+    for f in futures:
+        try:
+            f.result()
+        except Exception as e:
+            print(f"[CTX] _finalize_turn user_id={user_id} err={e}")
+
+
+def _push_reply(user_id, ai_reply):
+    """push 帶 Quick Reply 的 AI 回覆；可能因 LINE 月額度限制而失敗（429）。"""
+    try:
+        line_bot_api.push_message(user_id, text_with_quick_reply(ai_reply))
+    except Exception as e:
+        print(f">>> DEBUG: push_message failed (likely quota). err={e}")
+
 # --- AI 核心函數（模式路由器）---
 # _process_assistant_sync / _revision_handler 均在背景 thread 執行，可安全存取模組全域
 #（line_bot_api, redis, client）及 os.environ，無須額外傳遞。
-def _process_assistant_sync(user_id, text):
-    """Assistant API 邏輯：Thread/Run/RAG，完成後 push_message。供 process-text-async 背景呼叫。"""
+def _cancel_assistant_run(thread_id, run_id):
     try:
-        mode = _safe_get_mode(user_id)
-        if mode == REVISION_MODE:
-            _revision_handler(user_id, text)
-            return
-        tag = "🩺 中醫問答"
-        if mode == "speaking":
-            tag = "🗣️ 口說練習"
-        elif mode == "writing":
-            tag = "✍️ 寫作修訂"
+        client.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
+    except Exception as e:
+        print(f"[ASSISTANT] cancel run failed thread_id={thread_id} err={e}")
+
 
-        thread_id = None
+def _stream_assistant_run(thread_id, user_content, instructions=None, deadline=None):
+    """
+    以 Assistants Streaming 執行 run：逐段接收文字，不再每秒 runs.retrieve 輪詢。
+    使用者訊息以 additional_messages 隨 run 一併送出，省去 messages.create 一次往返；
+    thread_id 為 None（新使用者）時以 create_and_run_stream 同時建立 thread 與 run，省去 threads.create。
+    instructions（固定的 RAG 規則）以 additional_instructions 附在 system 端：前綴每回合相同，可命中 OpenAI prompt cache，
+    也不會在 thread 歷史中逐則累積。create_and_run 無此參數（instructions 會覆蓋 assistant 設定），新 thread 改放在首則訊息前。
+    超過 deadline（預設 TIMEOUT_SECONDS 後）即中止等待（run 不取消，由呼叫端決定）。回傳 (status, reply_text, thread_id, run_id)。
+    """
+    if deadline is None:
+        deadline = time.monotonic() + TIMEOUT_SECONDS
+    read_timeout = max(1.0, deadline - time.monotonic())
+    parts = []
+    status = "in_progress"
+    if thread_id:
+        manager = client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            additional_instructions=instructions or None,
+            additional_messages=[{"role": "user", "content": user_content}],
+            timeout=read_timeout,
+        )
+    else:
+        first_content = f"{instructions}\n\n{user_content}" if instructions else user_content
+        manager = client.beta.threads.create_and_run_stream(
+            assistant_id=assistant_id,
+            thread={"messages": [{"role": "user", "content": first_content}]},
+            timeout=read_timeout,
+        )
+    stream = None
+    try:
+        with manager as stream:
+            # 逐一處理所有事件（含 queued / file_search 等無文字的階段），每個事件都檢查 deadline
+            for event in stream:
+                if event.event == "thread.created":
+                    thread_id = event.data.id
+                elif event.event == "thread.message.delta":
+                    for block in event.data.delta.content or []:
+                        if getattr(block, "type", "") == "text" and block.text and block.text.value:
+                            parts.append(block.text.value)
+                if time.monotonic() > deadline:
+                    print(f"[ASSISTANT] stream timeout thread_id={thread_id}")
+                    return ("expired", "".join(parts)) + _stream_run_ids(stream, thread_id)
+            run = stream.current_run
+            run_id = None
+            if run is not None:
+                status = run.status
+                thread_id = run.thread_id
+                run_id = run.id
+    except (APITimeoutError, httpx.TimeoutException) as e:
+        # timeout 為單次讀取上限：事件間隔過久時視同逾時，仍交由呼叫端保留 run 與記下 thread
+        print(f"[ASSISTANT] stream read timeout thread_id={thread_id} err={e}")
+        return ("expired", "".join(parts)) + _stream_run_ids(stream, thread_id)
+    return status, "".join(parts).strip(), thread_id, run_id
+
+
+def _stream_run_ids(stream, thread_id):
+    """逾時時取出 stream 已知的 (thread_id, run_id)；run 尚未建立時 run_id 為 None。"""
+    run = stream.current_run if stream is not None else None
+    if run is None:
+        return thread_id, None
+    return run.thread_id, run.id
+
+
+def _question_digest(text):
+    return hashlib.sha1(" ".join((text or "").split()).lower().encode("utf-8")).hexdigest()[:16]
+
+
+def _park_expired_run(user_id, thread_id, run_id, text):
+    """
+    逾時的 run 不取消，記下 pending_run 讓它在 OpenAI 端跑完；使用者依提示重問同一題時直接取用答案，
+    不再開新 run 重算。Redis 不可用時退回取消，避免 thread 卡著進行中的 run。
+    """
+    if redis:
         try:
-            if redis:
-                t_id = redis.get(f"user_thread:{user_id}")
-                if t_id is not None:
-                    thread_id = t_id.decode("utf-8") if hasattr(t_id, "decode") else str(t_id)
-                    if thread_id == "None" or not thread_id.strip():
-                        thread_id = None
-        except Exception:
-            pass
+            redis.set(
+                _PENDING_RUN_KEY.format(user_id=user_id),
+                json.dumps({"thread": thread_id, "run": run_id, "q": _question_digest(text)}),
+                ex=_PENDING_RUN_TTL,
+            )
+            return
+        except Exception as e:
+            print(f"[ASSISTANT] park run failed user_id={user_id} err={e}")
+    _fanout_pool.submit(_cancel_assistant_run, thread_id, run_id)
 
-        if not thread_id:
-            new_thread = client.beta.threads.create()
-            thread_id = new_thread.id
-            try:
-                if redis:
-                    redis.set(f"user_thread:{user_id}", thread_id)
-            except Exception:
-                pass
 
-        if mode == "writing":
-            mode_instructions = get_writing_mode_instructions()
-        else:
-            mode_instructions = get_rag_instructions()
+def _retrieve_run(thread_id, run_id):
+    """runs.retrieve 並讀取 openai-poll-after-ms：回傳 (run, 建議的下次輪詢秒數或 None)。"""
+    raw = client.beta.threads.runs.with_raw_response.retrieve(run_id=run_id, thread_id=thread_id)
+    hint = raw.headers.get("openai-poll-after-ms")
+    try:
+        hint = min(int(hint) / 1000, 2.0) if hint else None
+    except ValueError:
+        hint = None
+    return raw.parse(), hint
+
+
+def _resume_pending_run(user_id, pending, text, deadline):
+    """
+    處理上一回合逾時留下的 run，與本回合共用同一個 deadline。回傳 (reply, can_run)：
+    - 同一題且已完成：回傳其答案；
+    - 舊 run 已結束（或取消完成）：reply 為 None、can_run 為 True，可在同一 thread 開新 run；
+    - 舊 run 仍進行中：can_run 為 False。同一題重新記回 pending_run 讓它繼續跑；
+      不同題已送出取消但尚未結束（cancelling），此時開新 run 會被 OpenAI 以 thread 有進行中 run 拒絕。
+    """
+    try:
+        info = json.loads(pending)
+        thread_id, run_id = info["thread"], info["run"]
+    except Exception:
+        return None, True
+    try:
+        if redis:
+            redis.delete(_PENDING_RUN_KEY.format(user_id=user_id))
+    except Exception:
+        pass
+    same_question = info.get("q") == _question_digest(text)
+    active = ("queued", "in_progress", "requires_action", "cancelling")
+    try:
+        backoff = 0.25
+        run, hint = _retrieve_run(thread_id, run_id)
+        cancelled = False
+        while run.status in active:
+            if not same_question and not cancelled and run.status != "cancelling":
+                _cancel_assistant_run(thread_id, run_id)
+                cancelled = True
+            # 伺服器有建議間隔（openai-poll-after-ms）時照用，否則指數退避；加少量抖動避免多位使用者同時輪詢
+            delay = (hint if hint is not None else backoff) + random.uniform(0, 0.1)
+            if time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+            backoff = min(backoff * 2, 2.0)
+            run, hint = _retrieve_run(thread_id, run_id)
+        if run.status in active:
+            if same_question:
+                _park_expired_run(user_id, thread_id, run_id, text)
+            elif not cancelled:
+                _cancel_assistant_run(thread_id, run_id)
+            return None, False
+        if not same_question or run.status != "completed":
+            return None, True
+        msgs = client.beta.threads.messages.list(thread_id=thread_id, run_id=run_id, order="desc", limit=1)
+        for msg in msgs.data:
+            for block in msg.content:
+                if getattr(block, "type", "") == "text":
+                    return (block.text.value or "").strip() or None, True
+    except Exception as e:
+        print(f"[ASSISTANT] resume pending run failed user_id={user_id} err={e}")
+    return None, True
+
+
+def _process_assistant_sync(user_id, text, ctx=None):
+    """
+    Assistant API 邏輯：Thread/Run/RAG，完成後 push_message。供 process-text-async 背景呼叫。
+    ctx 為 _load_user_ctx 已讀取的使用者狀態；未提供時自行以單一 pipeline 讀取。
+    """
+    # 整個回合（含處理上次逾時的 run 與新 run）共用一個期限，避免兩段各等滿 TIMEOUT_SECONDS
+    turn_deadline = time.monotonic() + TIMEOUT_SECONDS
+    try:
+        if ctx is None:
+            ctx = _load_user_ctx(user_id)
+        mode = _ctx_mode(user_id, ctx)
+        if mode == REVISION_MODE:
+            _revision_handler(user_id, text)
+            return
+        # 寫作模式（REVISION_MODE）已於上方交給 _revision_handler，不會建立 Assistant thread/run
+        tag = MODE_LABELS["speaking"] if mode == "speaking" else MODE_LABELS["tcm"]
+
+        thread_id = ctx.get("thread") or _get_cached_thread(user_id)
+
+        # 語意快取：僅中醫模式、且尚無 thread（首問）才查；追問依賴對話脈絡，口說回覆因人而異，皆不共用
+        use_semcache = mode == "tcm" and not thread_id
+        cached_reply, cache_emb = (None, None)
+        if use_semcache:
+            cached_reply, cache_emb = semcache_lookup(redis, client, text, mode)
+        if cached_reply:
+            ai_reply = cached_reply.rstrip() + SAFETY_DISCLAIMER
+            _finalize_turn(user_id, text, ai_reply, lambda: _push_reply(user_id, ai_reply))
+            return
 
-        user_content = f"{mode_instructions}\n\n【{tag}】\n使用者的話：{text}"
+        user_content = f"【{tag}】\n使用者的話：{text}"
         if mode == "tcm":
             user_content += "\n(提醒：回答末尾請提供參考資料出處)"
 
-        client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_content,
-        )
-        run = client.beta.threads.runs.create_and_poll(
-            thread_id=thread_id,
-            assistant_id=assistant_id,
-            timeout=TIMEOUT_SECONDS,
-        )
+        # 上一回合逾時：使用者重問同一題時沿用已在背景跑完的 run，不重新計算
+        if ctx.get("pending_run"):
+            resumed, can_run = _resume_pending_run(user_id, ctx["pending_run"], text, turn_deadline)
+            if resumed:
+                print(f"[ASSISTANT] resumed pending run user_id={user_id}")
+                if use_semcache:
+                    _background_pool.submit(semcache_store, redis, client, text, mode, resumed, cache_emb)
+                ai_reply = resumed.rstrip() + SAFETY_DISCLAIMER if mode == "tcm" else resumed
+                _finalize_turn(user_id, text, ai_reply, lambda: _push_reply(user_id, ai_reply))
+                return
+            # 舊 run 仍佔住 thread，或本回合剩餘時間不夠再跑一次：直接請使用者稍後再問
+            if not can_run or turn_deadline - time.monotonic() < _MIN_RUN_SECONDS:
+                print(f"[ASSISTANT] pending run blocks new run user_id={user_id} can_run={can_run}")
+                line_bot_api.push_message(user_id, text_with_quick_reply(TIMEOUT_MESSAGE))
+                return
 
-        if run.status == 'completed':
-            messages = client.beta.threads.messages.list(thread_id=thread_id)
-            ai_reply = messages.data[0].content[0].text.value
+        status, ai_reply, run_thread_id, run_id = _stream_assistant_run(
+            thread_id, user_content, instructions=get_rag_instructions(), deadline=turn_deadline
+        )
+        if status == "expired" and run_id:
+            _park_expired_run(user_id, run_thread_id, run_id, text)
+        # 新使用者：thread 隨 run 建立，事後再記下 thread id（成功時併入收尾 pipeline，不另開一次往返）
+        new_thread_id = run_thread_id if run_thread_id and run_thread_id != thread_id else None
+        if new_thread_id:
+            _set_cached_thread(user_id, new_thread_id)
+
+        if status == 'completed' and ai_reply:
+            if use_semcache:
+                _background_pool.submit(semcache_store, redis, client, text, mode, ai_reply, cache_emb)
             if mode == "tcm":
                 ai_reply = ai_reply.rstrip() + SAFETY_DISCLAIMER
-            # 注意：push_message 可能因 LINE 月額度限制而失敗（429）
-            try:
-                line_bot_api.push_message(user_id, text_with_quick_reply(ai_reply))
-            except Exception as e:
-                print(f">>> DEBUG: push_message failed (likely quota). err={e}")
-            try:
-                log_question(redis, user_id, text)
-                set_last_question(redis, user_id, text)
-                set_last_assistant_message(redis, user_id, ai_reply)
-            except Exception:
-                pass
+            _finalize_turn(user_id, text, ai_reply, lambda: _push_reply(user_id, ai_reply), thread_id=new_thread_id)
         else:
+            if new_thread_id:
+                try:
+                    if redis:
+                        redis.set(f"user_thread:{user_id}", new_thread_id)
+                except Exception:
+                    pass
             try:
                 line_bot_api.push_message(user_id, text_with_quick_reply(TIMEOUT_MESSAGE))
             except Exception as e:
@@ -1565,15 +2284,17 @@ def _process_assistant_sync(user_id, text):
             print(f">>> DEBUG: push_message TIMEOUT failed err={e}")
 
 
-def _run_ai_work(user_id, text, is_voice=False):
+def _run_ai_work(user_id, text, is_voice=False, ctx=None):
     """依 mode 分派：REVISION_MODE → _revision_handler；其餘 → _process_assistant_sync。"""
     try:
-        mode = _safe_get_mode(user_id)
+        if ctx is None:
+            ctx = _load_user_ctx(user_id)
+        mode = _ctx_mode(user_id, ctx)
         print(f"[MODE] _run_ai_work user_id={user_id} mode={mode} routing={'revision' if mode == REVISION_MODE else 'assistant'}")
         if mode == REVISION_MODE:
             _revision_handler(user_id, text)
             return
-        _process_assistant_sync(user_id, text)
+        _process_assistant_sync(user_id, text, ctx=ctx)
     except Exception as e:
         print(f"CRITICAL ERROR: {traceback.format_exc()}")
         try:
@@ -1582,13 +2303,13 @@ def _run_ai_work(user_id, text, is_voice=False):
             pass
 
 
-def process_ai_request(event, user_id, text, is_voice=False):
+def process_ai_request(event, user_id, text, is_voice=False, ctx=None):
     """
     State-Based Router：依 user_state (mode) 切換，直接執行 AI 邏輯。
-    寫作模式 → _revision_handler；其餘 → _process_assistant_sync（內含 create_and_poll）。
+    寫作模式 → _revision_handler；其餘 → _process_assistant_sync（Assistants streaming）。
     """
     try:
-        _run_ai_work(user_id, text, is_voice=is_voice)
+        _run_ai_work(user_id, text, is_voice=is_voice, ctx=ctx)
     except Exception as e:
         print(f"CRITICAL ERROR: {traceback.format_exc()}")
         try:
@@ -1602,11 +2323,10 @@ def _run_text_background(user_id, text, task, base_url, cron_secret):
     print(f"[TEXT_BG] start user_id={user_id} task={task} has_base={bool(base_url)} has_secret={bool(cron_secret)}")
     if base_url and cron_secret:
         try:
-            r = requests.post(
+            r = _internal_http.post(
                 f"{base_url}/api/process-text-async",
                 json={"user_id": user_id, "text": text, "task": task},
                 headers={"Authorization": f"Bearer {cron_secret}"},
-                timeout=30,
             )
             print(f"[TEXT_BG] POST result status={r.status_code}")
         except Exception as e:
@@ -1655,21 +2375,48 @@ def cron_weekly_report():
 def home():
     return 'Line Bot Server is running!', 200
 
+@app.route("/warm", methods=['GET'])
+def warm():
+    """預熱端點：同步執行 _warmup（serverless 回應後背景執行緒可能被凍結），可由外部監控定期呼叫以維持實例溫熱。"""
+    _warmup()
+    return "", 204
+
 @app.route("/favicon.ico", methods=['GET'])
 @app.route("/favicon.png", methods=['GET'])
 def favicon():
     """避免瀏覽器/爬蟲請求 favicon 產生 404 日誌。"""
     return "", 204
 
+# 語音／圖片背景處理池：長駐 worker（Railway gunicorn）直接在同一 process 內執行，省去自我呼叫的 HTTP 往返
+_media_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="media")
+_MEDIA_CHUNK_SIZE = 64 * 1024  # 下載 LINE 音檔／圖片的讀取區塊大小
+
+
+def _run_media_task(fn, user_id, message_id, tag):
+    """
+    webhook 已先回覆確認訊息後，執行下載＋Whisper／Vision 等長時間工作。
+    長駐 worker 丟進 _media_pool 立即返回；Vercel 回應後實例可能被凍結，須在本次請求內同步完成。
+    """
+    if _IS_SERVERLESS:
+        print(f"[{tag}] running sync (serverless) user_id={user_id}")
+        fn(user_id, message_id)
+    else:
+        print(f"[{tag}] submitted to media pool user_id={user_id}")
+        _media_pool.submit(fn, user_id, message_id)
+
+
 def _run_voice_background(user_id, message_id, base_url, cron_secret):
     """Background Task：語音轉錄、GPT 分析、TTS、Cloudinary 上傳。不阻塞 webhook 回傳。"""
+    if not _IS_SERVERLESS:
+        _media_pool.submit(_process_voice_sync, user_id, message_id)
+        return
+    # Serverless：回應送出後實例可能被凍結，背景 thread 不可靠，才改以 HTTP 自我呼叫另起一個 function 執行
     if base_url and cron_secret:
         try:
-            requests.post(
+            _internal_http.post(
                 f"{base_url}/api/process-voice-async",
                 json={"user_id": user_id, "message_id": message_id},
                 headers={"Authorization": f"Bearer {cron_secret}"},
-                timeout=30,
             )
         except Exception:
             try:
@@ -1683,6 +2430,32 @@ def _run_voice_background(user_id, message_id, base_url, cron_secret):
             traceback.print_exc()
 
 
+def _wait_quietly(future):
+    """等待背景送出的訊息完成（失敗只記錄），用於維持 push 先後順序。"""
+    if future is None:
+        return
+    try:
+        future.result()
+    except Exception as e:
+        print(f"[VOICE] background push failed err={e}")
+
+
+def _log_speaking_turn(user_id, transcript_text):
+    """口說練習研究紀錄：transcript 長度、TCM 術語次數，並更新分析指標。"""
+    try:
+        ensure_user(mongo_db, user_id)
+        log_speaking(
+            mongo_db,
+            user_id,
+            len(transcript_text),
+            count_tcm_terms_in_text(transcript_text),
+            transcript_text,
+        )
+        run_analytics_middleware(mongo_db, user_id)
+    except Exception as e:
+        print(f">>> RESEARCH log_speaking error: {e}")
+
+
 def _process_voice_sync(user_id, message_id):
     """
     語音處理：Whisper 辨識 -> GPT 評估 -> TTS -> Cloudinary。
@@ -1693,57 +2466,41 @@ def _process_voice_sync(user_id, message_id):
         return
     try:
         print(f"[VOICE] start user_id={user_id} message_id={message_id}")
+        # 使用者狀態（Redis）與音檔下載（LINE）互不相依：狀態丟到背景讀取，與下載重疊
+        ctx_future = _fanout_pool.submit(_load_user_ctx, user_id)
         message_content = line_bot_api.get_message_content(message_id)
-        tmp_dir = tempfile.gettempdir()
-        temp_path = os.path.join(tmp_dir, f"{message_id}.m4a")
-        try:
-            with open(temp_path, "wb") as f:
-                for chunk in message_content.iter_content():
-                    f.write(chunk)
-        except Exception:
-            temp_path = os.path.join(os.path.dirname(__file__) or ".", f"{message_id}.m4a")
-            with open(temp_path, "wb") as f:
-                for chunk in message_content.iter_content():
-                    f.write(chunk)
-
-        with open(temp_path, "rb") as audio_file:
-            # 口說練習模式固定練英文，強制 language=en 避免 Whisper 誤判為中文
-            _whisper_lang = "en" if _safe_get_mode(user_id) == "speaking" or FORCE_LANG == "en" else None
-            _whisper_kwargs = {"model": "whisper-1", "file": audio_file}
-            if _whisper_lang:
-                _whisper_kwargs["language"] = _whisper_lang
-            transcript = client.audio.transcriptions.create(**_whisper_kwargs)
-        if os.path.isfile(temp_path):
-            try:
-                os.remove(temp_path)
-            except OSError:
-                pass
+        # 直接在記憶體組出音檔交給 Whisper，不經暫存檔（serverless 檔案系統唯讀／空間有限）
+        # SDK 預設 iter_content 每塊僅 1KB，改以 64KB 區塊一次寫入
+        audio_buf = io.BytesIO()
+        audio_buf.writelines(message_content.iter_content(chunk_size=_MEDIA_CHUNK_SIZE))
+        audio_buf.seek(0)
+        ctx = ctx_future.result()
+        mode = _ctx_mode(user_id, ctx)
+
+        # 口說練習模式固定練英文，強制 language=en 避免 Whisper 誤判為中文
+        _whisper_lang = "en" if mode == "speaking" or FORCE_LANG == "en" else None
+        _whisper_kwargs = {"model": "whisper-1", "file": (f"{message_id}.m4a", audio_buf, "audio/m4a")}
+        if _whisper_lang:
+            _whisper_kwargs["language"] = _whisper_lang
+        transcript = client.audio.transcriptions.create(**_whisper_kwargs)
 
         transcript_text = (transcript.text or "").strip()
         if FORCE_LANG == "en":
             transcription_msg = f"🎤 Recognized: \"{transcript_text}\""
         else:
             transcription_msg = f"🎤 辨識內容：「{transcript_text}」"
-        line_bot_api.push_message(user_id, TextSendMessage(text=transcription_msg))
-
-        mode = _safe_get_mode(user_id)
+        transcript_msg = TextSendMessage(text=transcription_msg)
+        transcript_push = None
+        if mode == "speaking":
+            # 口說模式：辨識內容的 push 與評估／TTS 並行，送出回饋前再等它完成，確保訊息順序
+            transcript_push = _fanout_pool.submit(line_bot_api.push_message, user_id, transcript_msg)
 
-        # 口說模式：記錄 transcript 長度與 TCM 術語次數
+        # 口說模式：記錄 transcript 長度與 TCM 術語次數（研究紀錄與回覆無關，背景執行，與評估／TTS 重疊）
         if mode == "speaking" and mongo_db is not None:
-            try:
-                ensure_user(mongo_db, user_id)
-                log_speaking(
-                    mongo_db,
-                    user_id,
-                    len(transcript_text),
-                    count_tcm_terms_in_text(transcript_text),
-                    transcript_text,
-                )
-                run_analytics_middleware(mongo_db, user_id)
-            except Exception as e:
-                print(f">>> RESEARCH log_speaking error: {e}")
+            _background_pool.submit(_log_speaking_turn, user_id, transcript_text)
 
         if mode == REVISION_MODE:
+            line_bot_api.push_message(user_id, transcript_msg)
             _revision_handler(user_id, transcript_text)
             print(f"[VOICE] done revision path")
             return
@@ -1751,7 +2508,10 @@ def _process_voice_sync(user_id, message_id):
             status, feedback, corrected_text = _evaluate_speech(transcript_text)
             is_en_speaking = FORCE_LANG == "en"
             if status == "Correct":
+                # TTS+Cloudinary 與下一句生成彼此獨立：先送出 TTS，再生成下一句
+                tts_future = _fanout_pool.submit(_generate_tts_and_store, transcript_text, VOICE_COACH_TTS_VOICE)
                 next_sentence = _generate_next_practice_sentence(transcript_text)
+                _prewarm_practice_tts(next_sentence)
                 if is_en_speaking:
                     praise = "Great pronunciation! Well done! 🎉\n\n🔊 Listen to the model pronunciation:"
                     if next_sentence:
@@ -1764,26 +2524,27 @@ def _process_voice_sync(user_id, message_id):
                         next_msg = f"💡 建議下一句：\n「{next_sentence}」\n\n直接傳語音跟著唸，或錄你自己想練習的句子都可以！"
                     else:
                         next_msg = "要再練習下一句嗎？"
-                line_bot_api.push_message(user_id, TextSendMessage(text=praise))
+                # 稱讚 / 示範語音 / 下一句合併為一次 push（LINE 單次最多 5 則），quick reply 只放最後一則
+                msgs = [TextSendMessage(text=praise)]
                 tts_err_msg = "Sorry, audio generation failed. Please try again." if is_en_speaking else VOICE_ERROR_MSG
                 try:
-                    audio_url, duration_ms = _generate_tts_and_store(transcript_text, voice=VOICE_COACH_TTS_VOICE)
+                    audio_url, duration_ms = tts_future.result()
                     if audio_url and duration_ms:
-                        line_bot_api.push_message(user_id, AudioSendMessage(original_content_url=audio_url, duration=duration_ms))
+                        msgs.append(AudioSendMessage(original_content_url=audio_url, duration=duration_ms))
                     else:
-                        line_bot_api.push_message(user_id, TextSendMessage(text=tts_err_msg))
+                        msgs.append(TextSendMessage(text=tts_err_msg))
                 except Exception as tts_err:
                     print(f"[VOICE] TTS err (Correct path): {tts_err}")
-                    line_bot_api.push_message(user_id, TextSendMessage(text=tts_err_msg))
-                line_bot_api.push_message(user_id, text_with_quick_reply_speak_practice(next_msg))
+                    msgs.append(TextSendMessage(text=tts_err_msg))
+                msgs.append(text_with_quick_reply_speak_practice(next_msg))
+                _wait_quietly(transcript_push)
+                line_bot_api.push_message(user_id, msgs)
                 print(f"[VOICE] done speaking Correct")
                 return
-            feedback_header = "📊 Speaking Practice Feedback" if is_en_speaking else "📊 口說練習回饋"
-            line_bot_api.push_message(
-                user_id,
-                text_with_quick_reply(f"{feedback_header}\n\n{feedback}"),
-            )
             text_for_tts = corrected_text.strip() if corrected_text else transcript_text
+            feedback_header = "📊 Speaking Practice Feedback" if is_en_speaking else "📊 口說練習回饋"
+            # 回饋 / 跟讀提示 / 示範語音 / 結尾提示合併為一次 push，quick reply 只放最後一則
+            msgs = [TextSendMessage(text=f"{feedback_header}\n\n{feedback}")]
             if is_en_speaking:
                 tts_label = f"🔊 Listen and repeat: \"{text_for_tts}\""
                 tts_sent_msg = "Demo audio sent! Ready for the next sentence?"
@@ -1792,33 +2553,31 @@ def _process_voice_sync(user_id, message_id):
                 tts_label = f"🔊 請跟著唸：「{text_for_tts}」"
                 tts_sent_msg = "示範語音已送上，要再練習下一句嗎？"
                 tts_err_msg = VOICE_ERROR_MSG
-            line_bot_api.push_message(user_id, TextSendMessage(text=tts_label))
+            msgs.append(TextSendMessage(text=tts_label))
             try:
                 audio_url, duration_ms = _generate_tts_and_store(text_for_tts, voice=VOICE_COACH_TTS_VOICE)
                 if audio_url and duration_ms:
-                    line_bot_api.push_message(
-                        user_id,
-                        AudioSendMessage(original_content_url=audio_url, duration=duration_ms),
-                    )
-                    line_bot_api.push_message(
-                        user_id,
-                        text_with_quick_reply_speak_practice(tts_sent_msg),
-                    )
+                    msgs.append(AudioSendMessage(original_content_url=audio_url, duration=duration_ms))
+                    msgs.append(text_with_quick_reply_speak_practice(tts_sent_msg))
                 else:
-                    line_bot_api.push_message(user_id, text_with_quick_reply_speak_practice(tts_err_msg))
+                    msgs.append(text_with_quick_reply_speak_practice(tts_err_msg))
             except Exception as tts_err:
                 print(f"[VOICE] TTS/Cloudinary err={tts_err}")
                 traceback.print_exc()
-                line_bot_api.push_message(user_id, text_with_quick_reply_speak_practice(tts_err_msg))
+                msgs.append(text_with_quick_reply_speak_practice(tts_err_msg))
+            _wait_quietly(transcript_push)
+            line_bot_api.push_message(user_id, msgs)
             print(f"[VOICE] done speaking NeedsImprovement")
             return
+        # 回覆可立即組出的分支（課務查詢、離題）把辨識內容併入同一次 push；
+        # 走 Assistant 的分支需數秒，先送辨識內容讓使用者知道已聽懂
         if is_course_inquiry_intent(transcript_text):
-            line_bot_api.push_message(user_id, TextSendMessage(text="正在查詢課務資料..."))
-            send_course_inquiry_flex(user_id)
+            send_course_inquiry_flex(user_id, lead_msgs=[transcript_msg, TextSendMessage(text="正在查詢課務資料...")])
         elif is_off_topic(transcript_text):
-            line_bot_api.push_message(user_id, text_with_quick_reply(OFF_TOPIC_REPLY))
+            line_bot_api.push_message(user_id, [transcript_msg, text_with_quick_reply(OFF_TOPIC_REPLY)])
         else:
-            process_ai_request(None, user_id, transcript_text, is_voice=True)
+            line_bot_api.push_message(user_id, transcript_msg)
+            process_ai_request(None, user_id, transcript_text, is_voice=True, ctx=ctx)
         print(f"[VOICE] done other mode")
     except Exception as e:
         print(f"[VOICE] CRITICAL err={e}")
@@ -1832,7 +2591,7 @@ def _process_voice_sync(user_id, message_id):
 def _process_quiz_sync(user_id, context, language="zh"):
     """
     依據中醫回答內容 context 產生三選一小測驗並 push 給使用者。
-    先以同步 redis.set 寫入 state 與 mode（TTL 1 小時），驗證後再送題目。
+    先以同步 redis.set 寫入 state 與 mode（TTL 1 小時）再送題目。
     language 由呼叫端傳入（"en"/"zh"），避免 race condition。
     """
     if not (context or "").strip():
@@ -1845,37 +2604,9 @@ def _process_quiz_sync(user_id, context, language="zh"):
     if not (quiz and quiz.get("question") and quiz.get("options") and quiz.get("answer")):
         return
     try:
-        # 同步寫入：state 與 mode 直接 redis.set，不經 background，TTL 至少 1 小時
-        if redis:
-            state_key = f"user_state:{user_id}"
-            mode_key = _redis_user_mode_key(user_id)
-            redis.set(state_key, STATE_QUIZ_WAITING, ex=3600)
-            redis.set(mode_key, "quiz", ex=3600)
-            verify_state = redis.get(state_key)
-            verify_mode = redis.get(mode_key)
-            if isinstance(verify_state, bytes):
-                verify_state = verify_state.decode("utf-8", errors="replace").strip()
-            else:
-                verify_state = str(verify_state or "").strip()
-            if isinstance(verify_mode, bytes):
-                verify_mode = verify_mode.decode("utf-8", errors="replace").strip()
-            else:
-                verify_mode = str(verify_mode or "").strip()
-            print(f"DEBUG: Write Verification - state key expected '{STATE_QUIZ_WAITING}', got '{verify_state}'")
-            print(f"DEBUG: Write Verification - mode key expected 'quiz', got '{verify_mode}'")
-            quiz_id = secrets.token_hex(8)
-            set_mcq_quiz_data(
-                redis,
-                user_id,
-                quiz.get("question", ""),
-                quiz.get("options", []),
-                quiz.get("answer", ""),
-                quiz.get("explanation", ""),
-                category="其他",
-                quiz_id=quiz_id,
-            )
-            set_quiz_pending(redis, user_id, quiz.get("question", ""))
-            print(f"DEBUG: Successfully updated {user_id} to quiz mode")
+        # 同步寫入（單一 pipeline）：不經 background，送題前狀態已就緒，TTL 1 小時
+        _write_quiz_state(user_id, quiz, category="其他")
+        print(f"DEBUG: Successfully updated {user_id} to quiz mode")
         if language == "en":
             quiz_text = (
                 "——\n📝 Quiz\n"
@@ -1896,11 +2627,6 @@ def _process_quiz_sync(user_id, context, language="zh"):
             user_id,
             TextSendMessage(text=quiz_text, quick_reply=quick_reply_quiz_choices()),
         )
-        if redis:
-            try:
-                redis.set(f"quiz_sent_at:{user_id}", str(time.time()), ex=3600)
-            except Exception:
-                pass
     except Exception:
         traceback.print_exc()
 
@@ -1965,11 +2691,7 @@ def process_text_async():
         print(f"[process-text-async] received user_id={user_id!r} task={task} text_len={len(text)}")
         if not user_id:
             return "Missing user_id", 400
-        threading.Thread(
-            target=_run_process_text_task,
-            args=(user_id, text, task),
-            daemon=True,
-        ).start()
+        _background_pool.submit(_run_process_text_task, user_id, text, task)
         return "OK", 200
     except Exception as e:
         print(f"[process-text-async] CRITICAL err={e}")
@@ -2008,45 +2730,138 @@ def process_quiz_async():
 
 @app.route("/audio/<token>", methods=['GET'])
 def serve_audio(token):
-    """提供 TTS 音檔給 LINE 播放（Redis 暫存，TTL 約 10 分鐘）。"""
+    """
+    提供 TTS 音檔給 LINE 播放（Cloudinary 未設定時的本機暫存檔，約 10 分鐘後清除）。
+    token 即內容雜湊，直接作為 ETag；支援 If-None-Match（304）與 Range（206），重播或拖曳不必重送整檔。
+    """
     try:
-        if not redis:
+        if not _TTS_TOKEN_RE.match(token or ""):
             return "Not Found", 404
-        b64 = redis.get(f"tts_audio:{token}")
-        if not b64:
+        data = _tts_mem_get(token)
+        if data is not None:
+            rv = Response(data, mimetype="audio/mpeg")
+            rv.set_etag(token)
+            rv.cache_control.public = True
+            rv.cache_control.max_age = _TTS_LOCAL_TTL
+            return rv.make_conditional(request, accept_ranges=True, complete_length=len(data))
+        path = _tts_local_path(token)
+        if not os.path.isfile(path):
             return "Not Found", 404
-        s = b64.decode("ascii") if hasattr(b64, "decode") else b64
-        data = base64.b64decode(s)
-        return Response(data, mimetype="audio/mpeg", direct_passthrough=True)
+        return send_file(path, mimetype="audio/mpeg", etag=token, max_age=_TTS_LOCAL_TTL, conditional=True)
     except Exception:
         return "Not Found", 404
 
+# 同一個 webhook 內不同使用者的事件並行處理（gevent worker 下為 greenlet，不佔額外 worker）
+_webhook_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="webhook")
+
+
+def _dispatch_line_event(event):
+    """依 @line_webhook_handler.add 註冊的 handler 處理單一事件（查找規則與 SDK WebhookHandler.handle 相同）。"""
+    func = None
+    if isinstance(event, MessageEvent):
+        func = line_webhook_handler._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+    if func is None:
+        func = line_webhook_handler._handlers.get(event.__class__.__name__)
+    if func is None:
+        func = line_webhook_handler._default
+    if func is None:
+        print(f"[WEBHOOK] no handler for event={event.__class__.__name__}")
+        return
+    func(event)
+
+
+# 重送事件去重：LINE 逾時重送時以 webhookEventId 辨識，已處理過的事件直接略過
+_WEBHOOK_EVENT_TTL = 600
+
+
+def _webhook_event_key(event):
+    eid = getattr(event, "webhook_event_id", None)
+    return f"webhook_evt:{eid}" if eid else None
+
+
+def _drop_redelivered_duplicates(events):
+    """
+    所有帶 webhookEventId 的事件以單一 pipeline 同步 SET NX（一次往返）：
+    SET 失敗代表另一個 worker 已處理（或正在處理）同一事件，直接略過；兩個 gunicorn worker 間也是原子判斷。
+    Redis 不可用時全部照常處理。
+    """
+    if not redis:
+        return events
+    keyed = [(event, _webhook_event_key(event)) for event in events]
+    keys = list(dict.fromkeys(key for _, key in keyed if key))
+    if not keys:
+        return events
+    try:
+        p = redis.pipeline(transaction=False)
+        for key in keys:
+            p.set(key, "1", ex=_WEBHOOK_EVENT_TTL, nx=True)
+        fresh = dict(zip(keys, p.execute()))
+    except Exception as e:
+        print(f"[WEBHOOK] dedupe failed err={e}")
+        return events
+    kept = []
+    for event, key in keyed:
+        if key and not fresh.get(key):
+            print(f"[WEBHOOK] skip duplicate event {key}")
+            continue
+        if key:
+            fresh[key] = False
+        kept.append(event)
+    return kept
+
+
+def _dispatch_user_events(events):
+    """同一使用者的事件依序處理，保留模式切換與作答的先後順序。"""
+    for event in events:
+        try:
+            _dispatch_line_event(event)
+        except Exception:
+            traceback.print_exc()
+
+
 @app.route("/callback", methods=['POST'])
 def callback():
-    """LINE Webhook 唯一入口（Railway 等長連線環境：直接執行 handle，gunicorn timeout 120s）。"""
+    """
+    LINE Webhook 唯一入口（Railway 等長連線環境：直接執行 handle，gunicorn timeout 120s）。
+    LINE 可能在一次 webhook 送來多則事件：依使用者分組，不同使用者並行、同一使用者依序。
+    """
     signature = request.headers.get('X-Line-Signature') or ''
-    body = request.get_data(as_text=True) or ''
+    # 只讀一次原始 bytes，不留 request 快取；SDK 驗章與 json 解析皆吃 str，於此解碼一次
+    body = request.get_data(cache=False).decode("utf-8", errors="replace")
     try:
-        line_webhook_handler.handle(body, signature)
+        payload = line_webhook_handler.parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
         abort(400)
+    try:
+        groups = {}
+        for event in _drop_redelivered_duplicates(payload.events or []):
+            source_id = getattr(getattr(event, "source", None), "user_id", None) or ""
+            groups.setdefault(source_id, []).append(event)
+        if len(groups) <= 1:
+            for events in groups.values():
+                _dispatch_user_events(events)
+        else:
+            futures = [_webhook_pool.submit(_dispatch_user_events, events) for events in groups.values()]
+            for f in futures:
+                f.result()
     except Exception as e:
         traceback.print_exc()
     return Response('OK', status=200)
 
-def _handle_quiz_answer(user_id, choice, reply_token=None):
+def _handle_quiz_answer(user_id, choice, reply_token=None, quiz_data=None, lang=None):
     """
     處理測驗作答（文字 A/B/C 或 Postback quiz_choice=A/B/C）。
     更新 MongoDB 對應 interaction 的 quiz_data，並回覆結果。reply_token 有值則 reply_message，否則 push_message。
+    quiz_data / lang 為呼叫端本回合已讀取的值，提供時不再重讀 Redis。
     """
-    qd = get_quiz_data(redis, user_id) or {}
+    qd = (quiz_data if quiz_data is not None else get_quiz_data(redis, user_id)) or {}
     if qd.get("type") != "mcq":
         if reply_token:
             line_bot_api.reply_message(reply_token, text_with_quick_reply("此題已失效，請輸入新問題繼續學習～"))
         return
     correct = str(qd.get("answer") or "").strip().upper()
     explanation = (qd.get("explanation") or "").strip()
-    user_lang = "en" if FORCE_LANG == "en" else _get_user_language(user_id)
+    user_lang = "en" if FORCE_LANG == "en" else (lang or _get_user_language(user_id))
     if user_lang == "en":
         guidance = "Hope this helps you understand TCM better! Feel free to ask another question anytime, and I will continue to answer and generate quizzes for you. ✨"
         if choice == correct:
@@ -2071,7 +2886,13 @@ def _handle_quiz_answer(user_id, choice, reply_token=None):
             record_weak_category(redis, user_id, (qd.get("category") or "其他"))
         except Exception:
             pass
-    sent_at = redis.get(f"quiz_sent_at:{user_id}") if redis else None
+    # 出題時間與對應 interaction id 一次 MGET 讀回
+    sent_at, interaction_id_raw = None, None
+    if redis:
+        try:
+            sent_at, interaction_id_raw = redis.mget(f"quiz_sent_at:{user_id}", f"quiz_interaction_id:{user_id}")
+        except Exception as e:
+            print(f"[QUIZ] read quiz meta failed user_id={user_id} err={e}")
     response_time_sec = None
     if sent_at is not None:
         try:
@@ -2080,10 +2901,9 @@ def _handle_quiz_answer(user_id, choice, reply_token=None):
             pass
     if mongo_db is not None:
         try:
-            interaction_id_raw = redis.get(f"quiz_interaction_id:{user_id}") if redis else None
             if interaction_id_raw is not None:
                 try:
-                    oid_str = interaction_id_raw.decode("utf-8", errors="replace").strip() if isinstance(interaction_id_raw, bytes) else str(interaction_id_raw).strip()
+                    oid_str = _decode_redis_str(interaction_id_raw)
                     if oid_str:
                         update_interaction_quiz_result(
                             mongo_db,
@@ -2106,17 +2926,7 @@ def _handle_quiz_answer(user_id, choice, reply_token=None):
             )
         except Exception as e:
             print(f">>> RESEARCH QuizResult logging error: {e}")
-    try:
-        if redis:
-            redis.delete(f"quiz_sent_at:{user_id}")
-            redis.delete(f"quiz_interaction_id:{user_id}")
-        set_user_state(redis, user_id, STATE_NORMAL)
-        if redis:
-            redis.set(_redis_user_mode_key(user_id), "tcm", ex=86400)
-        clear_quiz_data(redis, user_id)
-        clear_quiz_pending(redis, user_id)
-    except Exception:
-        pass
+    _clear_quiz_state(user_id)
     msg = text_with_quick_reply(reply)
     if reply_token:
         line_bot_api.reply_message(reply_token, msg)
@@ -2173,9 +2983,10 @@ def handle_postback(event):
         if data.startswith("quiz_choice="):
             choice = data.split("=", 1)[1].strip().upper()
             if choice in ("A", "B", "C"):
-                quiz_state = get_user_state(redis, user_id)
+                # state 與題目資料同一個 pipeline 讀取，作答時不再重讀
+                quiz_state, qd = get_quiz_state_and_data(redis, user_id)
                 if quiz_state == STATE_QUIZ_WAITING:
-                    _handle_quiz_answer(user_id, choice, reply_token=event.reply_token)
+                    _handle_quiz_answer(user_id, choice, reply_token=event.reply_token, quiz_data=qd)
                     return
         if data == "action=course" or data == "action=weekly":
             send_course_inquiry_flex(user_id, reply_token=event.reply_token)
@@ -2185,20 +2996,8 @@ def handle_postback(event):
             return
         # mode=tcm / mode=speaking / mode=writing（Rich Menu 切換）
         mode = data.split("=")[1].strip() if "=" in data else "tcm"
-        mode_map = {"tcm": "🩺 中醫問答", "speaking": "🗣️ 口說練習", "writing": "✍️ 寫作修訂"}
-        _set_cached_mode(user_id, mode)
-        redis_ok = False
-        try:
-            if redis:
-                redis.set(_redis_user_mode_key(user_id), mode)
-                redis_ok = True
-                # 寫入後立即讀回驗證（供除錯）
-                verify = redis.get(_redis_user_mode_key(user_id))
-                v = verify.decode("utf-8").strip() if isinstance(verify, bytes) else str(verify or "").strip()
-                verified = (v == mode)
-                print(f"[MODE] Postback user_id={user_id} set_mode={mode} redis_ok={redis_ok} verified={verified}")
-        except Exception as e:
-            print(f"[MODE] Postback user_id={user_id} set_mode={mode} redis_set_failed err={e}")
+        redis_ok = _set_mode(user_id, mode, ex=None)
+        print(f"[MODE] Postback user_id={user_id} set_mode={mode} redis_ok={redis_ok}")
         # 與 CLI/文字指令一致的切換訊息（寫作修訂需含操作指引）
         if mode == REVISION_MODE:
             msg = REVISION_MODE_PROMPT
@@ -2209,7 +3008,7 @@ def handle_postback(event):
             msg = "已切換至【🗣️ 口說練習】模式，可傳送語音或文字。"
             line_bot_api.reply_message(event.reply_token, text_with_quick_reply(msg))
         else:
-            msg = f"已切換至【{mode_map.get(mode, mode)}】模式"
+            msg = f"已切換至【{MODE_LABELS.get(mode, mode)}】模式"
             line_bot_api.reply_message(event.reply_token, text_with_quick_reply(msg))
     except Exception as e:
         traceback.print_exc()
@@ -2218,123 +3017,116 @@ def handle_postback(event):
         except Exception:
             pass
 
+# --- Rich Menu 按鈕 handler：(event, user_id, user_text)，由 _MENU_HANDLERS 以字面值查表分派 ---
+def _menu_tcm(event, user_id, user_text):
+    _set_mode(user_id, "tcm", retries=3)
+    if FORCE_LANG == "en" or user_text == "TCM Q&A":
+        confirm_msg = "Switched to [🩺 TCM Q&A] mode. What would you like to ask?"
+    else:
+        confirm_msg = "已切換至【🩺 中醫問答】模式，有什麼想問的嗎？"
+    line_bot_api.reply_message(
+        event.reply_token,
+        text_with_quick_reply(confirm_msg),
+    )
+
+
+def _menu_speaking(event, user_id, user_text):
+    _set_mode(user_id, "speaking", retries=3)
+    if FORCE_LANG == "en" or user_text == "Speaking Practice":
+        confirm_msg = "Switched to [🗣️ Speaking Practice] mode. Send a voice message or type a sentence."
+    else:
+        confirm_msg = "已切換至【🗣️ 口說練習】模式，可傳送語音或文字。"
+    line_bot_api.reply_message(event.reply_token, text_with_quick_reply(confirm_msg))
+
+
+def _menu_writing(event, user_id, user_text):
+    _set_mode(user_id, REVISION_MODE, retries=3)
+    if FORCE_LANG == "en" or user_text == "Writing Revision":
+        msg = "You are now in [✍️ Writing Revision] mode. Please paste the paragraph you'd like to revise."
+        if not redis:
+            msg += "\n\n⚠️ Mode could not be saved (Redis not configured). Please check the REDIS_URL environment variable."
+    else:
+        msg = REVISION_MODE_PROMPT
+        if not redis:
+            msg += "\n\n⚠️ 模式無法儲存（Redis 未設定），請確認 REDIS_URL 環境變數。"
+    line_bot_api.reply_message(event.reply_token, text_with_quick_reply_writing(msg))
+
+
+def _menu_course_inquiry(event, user_id, user_text):
+    send_course_inquiry_flex(user_id, reply_token=event.reply_token)
+
+
+def _menu_time_locked_quiz(event, user_id, user_text):
+    time_locked_quiz_handler(user_id, reply_token=event.reply_token)
+
+
+def _menu_quiz_mode(event, user_id, user_text):
+    line_bot_api.reply_message(
+        event.reply_token,
+        text_with_quick_reply(
+            "您現在就在「中醫問答 ＋ 小測驗」循環中～\n\n"
+            "輸入任何中醫相關問題，我會先回答，再自動出一題小測驗。答完後可繼續問新問題，形成 QA → Quiz → QA → Quiz 的學習循環喔！✨"
+        ),
+    )
+
+
+# 測驗選項解析用的 regex 於模組載入時編譯一次，不在每則訊息重建
+_MCQ_LEAD_PUNCT_RE = re.compile(r'^[\s【\[\(（『「〈《<"\'`，。、．\.\!！\?？；;：:、]+')
+_MCQ_TRAIL_PUNCT_RE = re.compile(r'[\s】\]\)）』」〉》>"\'`，。、．\.\!！\?？；;：:、]+$')
+_MCQ_CHOICE_RE = re.compile(r"^(?:選\s*([ABC])|\(([ABC])\)|（([ABC])）)")
+_MCQ_FULLWIDTH = str.maketrans("ＡＢＣ", "ABC")
+
+
+def _parse_mcq_choice(text):
+    """解析使用者作答文字（A / 選B / (C) / 【Ａ】 等），回傳 "A"/"B"/"C" 或 None。"""
+    t = (text or "").strip()
+    if not t:
+        return None
+    # 移除常見包裹符號與標點，全形轉半形
+    norm = _MCQ_TRAIL_PUNCT_RE.sub("", _MCQ_LEAD_PUNCT_RE.sub("", t))
+    up = norm.translate(_MCQ_FULLWIDTH).upper()
+    if up in ("A", "B", "C"):
+        return up
+    m = _MCQ_CHOICE_RE.match(up)
+    if m:
+        return next(g for g in m.groups() if g)
+    return None
+
+
+_MENU_HANDLERS = {
+    "中醫問答": _menu_tcm,
+    "回到中醫問答": _menu_tcm,
+    "TCM Q&A": _menu_tcm,
+    "口說練習": _menu_speaking,
+    "Speaking Practice": _menu_speaking,
+    "寫作修改": _menu_writing,
+    "寫作修訂": _menu_writing,
+    "Writing Revision": _menu_writing,
+    "課務查詢": _menu_course_inquiry,
+    "時間解鎖小測驗": _menu_time_locked_quiz,
+    "測驗模式": _menu_quiz_mode,
+}
+
+
 @line_webhook_handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_id = event.source.user_id
     user_text = (event.message.text or "").strip()
-    current_mode = _safe_get_mode(user_id)
+    ctx = _load_user_ctx(user_id)
+    current_mode = _ctx_mode(user_id, ctx)
     print(f"DEBUG: Received text '{user_text}' from {user_id}. Current Mode from Redis: {current_mode}")
     try:
-        def _parse_mcq_choice(text):
-            t = (text or "").strip()
-            if not t:
-                return None
-            # 移除常見包裹符號與標點
-            norm = re.sub(r'^[\s【\[\(（『「〈《<"\'`，。、．\.\!！\?？；;：:、]+', "", t)
-            norm = re.sub(r'[\s】\]\)）』」〉》>"\'`，。、．\.\!！\?？；;：:、]+$', "", norm)
-            # 全形轉半形
-            norm = norm.replace("Ａ", "A").replace("Ｂ", "B").replace("Ｃ", "C")
-            up = norm.upper()
-            if up in ("A", "B", "C"):
-                return up
-            if re.match(r"^選\s*[ABC]", up):
-                return re.findall(r"[ABC]", up)[0]
-            if re.match(r"^\([ABC]\)", up) or re.match(r"^（[ABC]）", up):
-                return re.findall(r"[ABC]", up)[0]
-            return None
-
         suppress_yes_no_command = False
 
-        # --- Rich Menu 按鈕：立即回覆，避免延遲 ---
-        if user_text in ("中醫問答", "回到中醫問答", "TCM Q&A"):
-            _set_cached_mode(user_id, "tcm")
-            if redis:
-                for _attempt in range(3):
-                    try:
-                        with _redis_mode_lock:
-                            redis.set(_redis_user_mode_key(user_id), "tcm", ex=86400)
-                        break
-                    except Exception as _e:
-                        print(f"[MODE] TCM Q&A redis set failed attempt={_attempt} err={_e}")
-                        if _attempt < 2:
-                            time.sleep(0.2)
-            if FORCE_LANG == "en" or user_text == "TCM Q&A":
-                confirm_msg = "Switched to [🩺 TCM Q&A] mode. What would you like to ask?"
-            else:
-                confirm_msg = "已切換至【🩺 中醫問答】模式，有什麼想問的嗎？"
-            line_bot_api.reply_message(
-                event.reply_token,
-                text_with_quick_reply(confirm_msg),
-            )
-            return
-        if user_text in ("口說練習", "Speaking Practice"):
-            _set_cached_mode(user_id, "speaking")
-            if redis:
-                for _attempt in range(3):
-                    try:
-                        with _redis_mode_lock:
-                            redis.set(_redis_user_mode_key(user_id), "speaking", ex=86400)
-                        break
-                    except Exception as _e:
-                        print(f"[MODE] Speaking Practice redis set failed attempt={_attempt} err={_e}")
-                        if _attempt < 2:
-                            time.sleep(0.2)
-            if FORCE_LANG == "en" or user_text == "Speaking Practice":
-                confirm_msg = "Switched to [🗣️ Speaking Practice] mode. Send a voice message or type a sentence."
-            else:
-                confirm_msg = "已切換至【🗣️ 口說練習】模式，可傳送語音或文字。"
-            line_bot_api.reply_message(event.reply_token, text_with_quick_reply(confirm_msg))
-            return
-        if user_text in ("寫作修改", "寫作修訂", "Writing Revision"):
-            _set_cached_mode(user_id, REVISION_MODE)
-            if redis:
-                for _attempt in range(3):
-                    try:
-                        with _redis_mode_lock:
-                            redis.set(_redis_user_mode_key(user_id), REVISION_MODE, ex=86400)
-                        break
-                    except Exception as _e:
-                        print(f"[MODE] Writing Revision redis set failed attempt={_attempt} err={_e}")
-                        if _attempt < 2:
-                            time.sleep(0.2)
-            if FORCE_LANG == "en" or user_text == "Writing Revision":
-                msg = "You are now in [✍️ Writing Revision] mode. Please paste the paragraph you'd like to revise."
-                if not redis:
-                    msg += "\n\n⚠️ Mode could not be saved (Redis not configured). Please check the REDIS_URL environment variable."
-            else:
-                msg = REVISION_MODE_PROMPT
-                if not redis:
-                    msg += "\n\n⚠️ 模式無法儲存（Redis 未設定），請確認 REDIS_URL 環境變數。"
-            line_bot_api.reply_message(event.reply_token, text_with_quick_reply_writing(msg))
-            return
-        if user_text == "課務查詢":
-            send_course_inquiry_flex(user_id, reply_token=event.reply_token)
-            return
-        if user_text == "時間解鎖小測驗":
-            time_locked_quiz_handler(user_id, reply_token=event.reply_token)
-            return
-        if (user_text or "").strip() == "測驗模式":
-            line_bot_api.reply_message(
-                event.reply_token,
-                text_with_quick_reply(
-                    "您現在就在「中醫問答 ＋ 小測驗」循環中～\n\n"
-                    "輸入任何中醫相關問題，我會先回答，再自動出一題小測驗。答完後可繼續問新問題，形成 QA → Quiz → QA → Quiz 的學習循環喔！✨"
-                ),
-            )
+        # --- Rich Menu 按鈕：字面值查表直接分派，立即回覆，避免延遲 ---
+        menu_handler = _MENU_HANDLERS.get(user_text)
+        if menu_handler:
+            menu_handler(event, user_id, user_text)
             return
 
         # --- 寫作修訂模式隔離：優先判斷，跳過中醫邏輯 ---
-        # 直接讀 Redis（繞過本地快取），避免 Vercel 多實例快取不同步導致誤判
-        current_mode = None
-        if redis:
-            try:
-                _v = redis.get(_redis_user_mode_key(user_id))
-                if _v:
-                    current_mode = (_v.decode("utf-8") if isinstance(_v, bytes) else str(_v)).strip()
-            except Exception:
-                pass
-        if not current_mode:
-            current_mode = _safe_get_mode(user_id)
+        # ctx 於本回合開頭直接由 Redis pipeline 讀取（繞過本地快取），避免 Vercel 多實例快取不同步導致誤判
+        current_mode = _ctx_mode(user_id, ctx)
         print(f"[MODE] handle_message user_id={user_id} current_mode={current_mode} text_preview={user_text[:50]!r}")
         if current_mode == REVISION_MODE:
             print(f"[MODE] handle_message -> REVISION_MODE branch, skipping TCM Assistant")
@@ -2356,23 +3148,26 @@ def handle_message(event):
             _revision_handler(user_id, user_text)
             return
 
-        # 課務查詢／本週重點：統一以 Flex Message 回傳
-        if is_course_inquiry_intent(user_text):
+        # 課務查詢／本週重點：統一以 Flex Message 回傳（Quick Reply 按鈕字面值直接略過意圖判斷）
+        if user_text not in _QUICK_REPLY_LITERALS and is_course_inquiry_intent(user_text):
             send_course_inquiry_flex(user_id, reply_token=event.reply_token)
             return
 
-        # 小測驗等待作答：A/B/C/D 時再讀一次 state，避免漏掉剛寫入的 quiz 狀態
-        quiz_state = get_user_state(redis, user_id)
+        # 小測驗等待作答：A/B/C/D 時以單一 pipeline 重讀 state 與 quiz_data，避免漏掉剛寫入的 quiz 狀態
+        quiz_state = ctx.get("state") or get_user_state(redis, user_id)
+        qd = None
         if (user_text or "").strip().upper() in ("A", "B", "C", "D"):
-            quiz_state = get_user_state(redis, user_id)
+            quiz_state, qd = get_quiz_state_and_data(redis, user_id)
         if quiz_state == STATE_QUIZ_WAITING:
             print("DEBUG: Inside Quiz logic block - comparing answer...")
-            mode = _safe_get_mode(user_id)
-            qd = get_quiz_data(redis, user_id) or {}
+            mode = _ctx_mode(user_id, ctx)
+            if qd is None:
+                qd = get_quiz_data(redis, user_id)
+            qd = qd or {}
             if mode in ("tcm", "quiz") and (qd.get("type") == "mcq"):
                 choice = _parse_mcq_choice(user_text)
                 if choice:
-                    _handle_quiz_answer(user_id, choice, reply_token=event.reply_token)
+                    _handle_quiz_answer(user_id, choice, reply_token=event.reply_token, quiz_data=qd, lang=ctx.get("lang"))
                     return
 
                 # 非選項：視為跳過，清狀態後把這則當新提問（且不要把「是/否」當作舊題庫指令）
@@ -2381,7 +3176,7 @@ def handle_message(event):
                     if mongo_db is not None and redis:
                         interaction_id_raw = redis.get(f"quiz_interaction_id:{user_id}")
                         if interaction_id_raw is not None:
-                            oid_str = interaction_id_raw.decode("utf-8", errors="replace").strip() if isinstance(interaction_id_raw, bytes) else str(interaction_id_raw).strip()
+                            oid_str = _decode_redis_str(interaction_id_raw)
                             if oid_str:
                                 try:
                                     update_interaction_quiz_result(
@@ -2393,46 +3188,21 @@ def handle_message(event):
                                     )
                                 except Exception:
                                     pass
-                            redis.delete(f"quiz_interaction_id:{user_id}")
-                    set_user_state(redis, user_id, STATE_NORMAL)
-                    if redis:
-                        redis.set(_redis_user_mode_key(user_id), "tcm", ex=86400)
-                    clear_quiz_data(redis, user_id)
-                    clear_quiz_pending(redis, user_id)
                 except Exception:
                     pass
+                _clear_quiz_state(user_id)
+                ctx["mode"] = "tcm"
             else:
                 # 非 tcm/quiz 或非 MCQ：維持舊相容邏輯（視為新提問）
-                try:
-                    set_user_state(redis, user_id, STATE_NORMAL)
-                    if redis:
-                        redis.set(_redis_user_mode_key(user_id), "tcm", ex=86400)
-                    clear_quiz_data(redis, user_id)
-                    clear_quiz_pending(redis, user_id)
-                except Exception:
-                    pass
+                _clear_quiz_state(user_id)
+                ctx["mode"] = "tcm"
 
         # 主動複習測驗：依最近 10 筆互動產生個人化複習題
         if user_text in ("複習測驗", "我要複習測驗") and mongo_db is not None:
             try:
                 review_quiz = generate_review_quiz_from_interactions(mongo_db, user_id, client, last_n=10)
                 if review_quiz and review_quiz.get("question") and review_quiz.get("options") and review_quiz.get("answer"):
-                    if redis:
-                        redis.set(f"user_state:{user_id}", STATE_QUIZ_WAITING, ex=3600)
-                        redis.set(_redis_user_mode_key(user_id), "quiz", ex=3600)
-                        quiz_id_r = secrets.token_hex(8)
-                        set_mcq_quiz_data(
-                            redis,
-                            user_id,
-                            review_quiz.get("question", ""),
-                            review_quiz.get("options", []),
-                            review_quiz.get("answer", ""),
-                            review_quiz.get("explanation", ""),
-                            category="複習",
-                            quiz_id=quiz_id_r,
-                            quiz_type="Review",
-                        )
-                        set_quiz_pending(redis, user_id, review_quiz.get("question", ""))
+                    _write_quiz_state(user_id, review_quiz, category="複習", quiz_type="Review")
                     quiz_text = (
                         "——\n📝 複習測驗（依你最近的問答出題）\n"
                         + review_quiz["question"]
@@ -2444,8 +3214,6 @@ def handle_message(event):
                         event.reply_token,
                         TextSendMessage(text=quiz_text, quick_reply=quick_reply_quiz_choices()),
                     )
-                    if redis:
-                        redis.set(f"quiz_sent_at:{user_id}", str(time.time()), ex=3600)
                     return
                 line_bot_api.reply_message(event.reply_token, text_with_quick_reply("尚無足夠的問答記錄可出複習題，先多問幾題中醫問題吧～"))
             except Exception as e:
@@ -2458,7 +3226,7 @@ def handle_message(event):
             cat = get_pending_review_category(redis, user_id)
             clear_pending_review_category(redis, user_id)
             if cat:
-                note = generate_review_note(client, cat)
+                note = _get_review_note(cat)
                 clear_weak_category(redis, user_id, cat)
                 review_msg = text_with_quick_reply(f"📝 【{cat}】複習筆記\n\n{note}")
             else:
@@ -2495,9 +3263,10 @@ def handle_message(event):
             return
 
         if user_text in ("練習下一句", "Next Sentence"):
-            mode = _safe_get_mode(user_id)
+            mode = _ctx_mode(user_id, ctx)
             if mode == "speaking":
                 next_sentence = _generate_next_practice_sentence()
+                _prewarm_practice_tts(next_sentence)
                 if FORCE_LANG == "en" or user_text == "Next Sentence":
                     if next_sentence:
                         msg = f"💡 Try this sentence:\n\"{next_sentence}\"\n\nSend a voice message to practice, or record your own sentence!"
@@ -2514,18 +3283,7 @@ def handle_message(event):
                 )
                 return
         if user_text in ("結束練習", "End Practice"):
-            _set_cached_mode(user_id, "tcm")
-            if redis:
-                for _attempt in range(3):
-                    try:
-                        with _redis_mode_lock:
-                            redis.set(_redis_user_mode_key(user_id), "tcm", ex=86400)
-                        break
-                    except Exception as _e:
-                        print(f"[MODE] End Practice redis set failed attempt={_attempt} err={_e}")
-                        if _attempt < 2:
-                            time.sleep(0.2)
-            else:
+            if not _set_mode(user_id, "tcm", retries=3):
                 print(f"[MODE] End Practice: redis unavailable, mode only in local cache")
             if FORCE_LANG == "en" or user_text == "End Practice":
                 end_msg = "Speaking practice ended. Switched back to TCM Q&A mode."
@@ -2537,24 +3295,16 @@ def handle_message(event):
             )
             return
 
-        # 最終路由：直接讀 Redis，跳過本地快取，避免多 worker 快取不同步導致誤判
-        mode = None
-        if redis:
-            try:
-                with _redis_mode_lock:
-                    _rv = redis.get(_redis_user_mode_key(user_id))
-                if _rv:
-                    mode = (_rv.decode("utf-8") if isinstance(_rv, bytes) else str(_rv)).strip()
-            except Exception as _e:
-                print(f"[MODE] final routing redis read failed: {_e}")
-        if not mode:
-            mode = _safe_get_mode(user_id)
+        # 最終路由：沿用本回合開頭 pipeline 讀到的 mode（已繞過本地快取），不再重複 redis.get
+        mode = _ctx_mode(user_id, ctx)
         print(f"[MODE] handle_message -> AI (current_mode={mode!r})")
 
         # 統一 TCM 問答：tcm / quiz 一律走同一邏輯（避免 push：直接用 reply_token 回覆最終結果）
         if mode in ("tcm", "quiz"):
-            _start_loading_indicator(user_id)
-            if not _tcm_openai_reply(user_id, user_text, reply_token=event.reply_token):
+            # 載入動畫與生成回覆互不相依：動畫背景送出，回覆前再等它完成
+            loading = _fanout_pool.submit(_start_loading_indicator, user_id)
+            if not _tcm_openai_reply(user_id, user_text, reply_token=event.reply_token, loading=loading):
+                _wait_quietly(loading)
                 try:
                     line_bot_api.reply_message(event.reply_token, text_with_quick_reply("An error occurred, please try again." if FORCE_LANG == "en" else "處理時發生錯誤，請稍後再試。"))
                 except Exception:
@@ -2565,13 +3315,13 @@ def handle_message(event):
 
         # 口說 / 寫作：依模式顯示載入訊息並走 Assistant API
         if FORCE_LANG == "en":
-            mode_name = {"speaking": "🗣️ Speaking Practice", "writing": "✍️ Writing Revision"}.get(mode, mode)
+            mode_name = MODE_LABELS_EN.get(mode, mode)
             analyzing_msg = f"Analyzing in [{mode_name}] mode, please wait... ✨"
         else:
-            mode_name = {"speaking": "🗣️ 口說練習", "writing": "✍️ 寫作修訂"}.get(mode, mode)
+            mode_name = MODE_LABELS.get(mode, mode)
             analyzing_msg = f"正在以【{mode_name}】模式分析中..."
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=analyzing_msg))
-        _run_ai_work(user_id, user_text)
+        _run_ai_work(user_id, user_text, ctx=ctx)
     except Exception as e:
         traceback.print_exc()
         err_msg = str(e).strip()[:100]
@@ -2594,8 +3344,7 @@ def handle_audio(event):
         TextSendMessage(text="Converting voice, please wait... 🎙️" if FORCE_LANG == "en" else "正在轉換語音，請稍候... 🎙️"),
     )
 
-    print(f"[VOICE] running sync (worker) user_id={user_id}")
-    _process_voice_sync(user_id, message_id)
+    _run_media_task(_process_voice_sync, user_id, message_id, "VOICE")
 
 
 @line_webhook_handler.add(MessageEvent, message=ImageMessage)
@@ -2608,11 +3357,15 @@ def handle_image(event):
         event.reply_token,
         TextSendMessage(text="Analyzing image, please wait... 🖼️" if FORCE_LANG == "en" else "圖片分析中，請稍候... 🖼️"),
     )
+    _run_media_task(_process_image_sync, user_id, message_id, "IMAGE")
+
 
+def _process_image_sync(user_id, message_id):
+    """圖片處理：下載 → Vision 描述 → 中醫問答，結果一律 push。"""
     try:
         # 下載圖片並轉 base64
         content = line_bot_api.get_message_content(message_id)
-        image_data = b"".join(chunk for chunk in content.iter_content())
+        image_data = b"".join(content.iter_content(chunk_size=_MEDIA_CHUNK_SIZE))
         image_b64 = base64.b64encode(image_data).decode("utf-8")
 
         # GPT-4o-mini vision：擷取圖片內容描述
@@ -2677,7 +3430,38 @@ def handle_image(event):
             pass
 
 
+def _warmup_internal_http():
+    """Vercel 上預先與自身網域握手，供 /api/process-*-async 自我呼叫沿用。"""
+    vercel_url = (os.getenv("VERCEL_URL") or "").strip().rstrip("/")
+    if not vercel_url:
+        return
+    base_url = f"https://{vercel_url}" if not vercel_url.startswith("http") else vercel_url
+    _internal_http.head(f"{base_url}/", timeout=3)
+
+
+def _warmup():
+    """
+    冷啟動預熱：先與 OpenAI / Redis / LINE 建好 keep-alive 連線（TLS 握手在背景完成），
+    並填入 prompt 快取，讓第一則真正的訊息不必負擔這些成本。任何失敗都忽略。
+    """
+    for name, fn in (
+        ("openai", lambda: _http_client.head("https://api.openai.com/v1/models", timeout=3)),
+        ("redis", lambda: redis.ping() if redis else None),
+        ("line", lambda: _PooledRequestsHttpClient._session.head("https://api.line.me", timeout=3)),
+        ("self", _warmup_internal_http),
+        ("prompts", get_rag_instructions),
+    ):
+        try:
+            fn()
+        except Exception as e:
+            print(f"[WARMUP] {name} skipped err={e}")
+
+
+threading.Thread(target=_warmup, daemon=True).start()
+
+
 if __name__ == "__main__":
     # 本地快速測試：python -m api.index 或 python api/index.py（從專案根目錄）
     # 再開一個終端執行 ngrok http 5000，並將 LINE Webhook 改為 https://YOUR-NGROK-URL/callback
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # threaded=True：多使用者事件並行；debug 的 reloader 會重複載入模組（重跑 warmup、多建連線池），改為 FLASK_DEBUG=1 才開
+    app.run(host="0.0.0.0", port=5000, threaded=True, debug=os.getenv("FLASK_DEBUG") == "1")
@@ -54,7 +54,7 @@ def get_last_question(redis_client, user_id):
         val = redis_client.get(f"last_question:{user_id}")
         if val is None:
             return None
-        return val.decode("utf-8") if hasattr(val, "decode") else str(val)
+        return val
     except Exception:
         return None
 
@@ -76,7 +76,7 @@ def get_quiz_pending(redis_client, user_id):
         val = redis_client.get(f"quiz_pending:{user_id}")
         if val is None:
             return None
-        return val.decode("utf-8") if hasattr(val, "decode") else str(val)
+        return val
     except Exception:
         return None
 
@@ -107,8 +107,7 @@ def get_user_state(redis_client, user_id):
         val = redis_client.get(f"user_state:{user_id}")
         if val is None:
             return STATE_NORMAL
-        s = val.decode("utf-8") if hasattr(val, "decode") else str(val)
-        return s.strip() or STATE_NORMAL
+        return val.strip() or STATE_NORMAL
     except Exception:
         return STATE_NORMAL
 
@@ -157,6 +156,24 @@ def set_mcq_quiz_data(redis_client, user_id, question, options, answer, explanat
         pass
 
 
+# generate_mcq_quiz 結構化輸出 schema：模型保證回傳合法 JSON，不必再從 ``` 區塊擷取
+_MCQ_QUIZ_SCHEMA = {
+    "name": "mcq_quiz",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string"},
+            "options": {"type": "array", "items": {"type": "string"}},
+            "answer": {"type": "string", "enum": ["A", "B", "C"]},
+            "explanation": {"type": "string"},
+        },
+        "required": ["question", "options", "answer", "explanation"],
+        "additionalProperties": False,
+    },
+}
+
+
 def generate_mcq_quiz(openai_client, context, language="zh"):
     """
     Generate a 3-choice multiple-choice quiz based on the given context.
@@ -218,26 +235,15 @@ Based on the following explanation content that was just provided to a student,
                 {"role": "system", "content": system_msg},
                 {"role": "user", "content": prompt},
             ],
-            max_tokens=200,
+            # 題目＋三選項＋詳解的中文 JSON 常超過 200 tokens，截斷會讓整題作廢
+            max_tokens=400,
             temperature=0.2,
+            response_format={"type": "json_schema", "json_schema": _MCQ_QUIZ_SCHEMA},
         )
         raw = (resp.choices[0].message.content or "").strip()
         if not raw:
             return None
-
-        # 嘗試擷取 JSON 區段
-        json_text = raw
-        if "```" in raw:
-            parts = raw.split("```")
-            for p in parts:
-                p = p.strip()
-                if p.startswith("json"):
-                    json_text = p[4:].strip()
-                    break
-        if "{" in json_text and "}" in json_text:
-            json_text = json_text[json_text.find("{") : json_text.rfind("}") + 1]
-
-        obj = json.loads(json_text)
+        obj = json.loads(raw)
         question = (obj.get("question") or "").strip()
         options = obj.get("options") or []
         options = [str(x) for x in options] if isinstance(options, list) else []
@@ -265,12 +271,37 @@ def get_quiz_data(redis_client, user_id):
         val = redis_client.get(f"quiz_data:{user_id}")
         if val is None:
             return None
-        s = val.decode("utf-8") if hasattr(val, "decode") else str(val)
-        return json.loads(s)
+        return json.loads(val)
     except Exception:
         return None
 
 
+def get_quiz_state_and_data(redis_client, user_id):
+    """
+    作答時所需的 user_state 與 quiz_data 一次 pipeline 讀取：
+    回傳 (state, quiz_data)，語意同 get_user_state / get_quiz_data。
+    """
+    if not redis_client:
+        return STATE_NORMAL, None
+    try:
+        p = redis_client.pipeline(transaction=False)
+        p.get(f"user_state:{user_id}")
+        p.get(f"quiz_data:{user_id}")
+        state_v, data_v = p.execute()
+    except Exception:
+        return STATE_NORMAL, None
+    state = STATE_NORMAL
+    if state_v is not None:
+        state = state_v.strip() or STATE_NORMAL
+    data = None
+    if data_v is not None:
+        try:
+            data = json.loads(data_v)
+        except Exception:
+            data = None
+    return state, data
+
+
 def clear_quiz_data(redis_client, user_id):
     if not redis_client:
         return
@@ -285,14 +316,21 @@ def record_weak_category(redis_client, user_id, category):
     if not redis_client or not category:
         return
     try:
-        key = f"user_weak:{user_id}"
-        val = redis_client.hget(key, category)
-        count = int(val) if val else 0
-        redis_client.hset(key, category, str(count + 1))
+        # HINCRBY 一次往返完成讀加寫，並發作答也不會互相覆蓋計數
+        redis_client.hincrby(f"user_weak:{user_id}", category, 1)
     except Exception:
         pass
 
 
+def _parse_weak_counts(data, min_count):
+    out = {}
+    for k, v in (data.items() if isinstance(data, dict) else []):
+        cnt = int(v) if v else 0
+        if cnt >= min_count:
+            out[k] = cnt
+    return out
+
+
 def get_weak_categories(redis_client, user_id, min_count=2):
     """回傳需加強的領域列表 (category -> count)，只回傳 count >= min_count。"""
     if not redis_client:
@@ -301,17 +339,36 @@ def get_weak_categories(redis_client, user_id, min_count=2):
         data = redis_client.hgetall(f"user_weak:{user_id}")
         if not data:
             return {}
-        out = {}
-        for k, v in (data.items() if isinstance(data, dict) else []):
-            cat = k.decode("utf-8") if hasattr(k, "decode") else str(k)
-            cnt = int(v) if v else 0
-            if cnt >= min_count:
-                out[cat] = cnt
-        return out
+        return _parse_weak_counts(data, min_count)
     except Exception:
         return {}
 
 
+def get_review_ask_state(redis_client, user_id, min_count=2):
+    """
+    主動複習判斷所需的兩項資料一次 pipeline 讀取：
+    回傳 (weak_categories, last_review_ask_ts)，語意同 get_weak_categories / get_last_review_ask。
+    """
+    if not redis_client:
+        return {}, 0
+    try:
+        p = redis_client.pipeline(transaction=False)
+        p.hgetall(f"user_weak:{user_id}")
+        p.get(f"last_review_ask:{user_id}")
+        data, last = p.execute()
+    except Exception:
+        return {}, 0
+    try:
+        weak = _parse_weak_counts(data or {}, min_count)
+    except Exception:
+        weak = {}
+    try:
+        last_ts = float(last) if last is not None else 0
+    except (TypeError, ValueError):
+        last_ts = 0
+    return weak, last_ts
+
+
 def clear_weak_category(redis_client, user_id, category):
     """使用者接受複習筆記後可清除該領域計數。"""
     if not redis_client:
@@ -330,7 +387,7 @@ def get_last_review_ask(redis_client, user_id):
         val = redis_client.get(f"last_review_ask:{user_id}")
         if val is None:
             return 0
-        return float(val.decode("utf-8") if hasattr(val, "decode") else val)
+        return float(val)
     except Exception:
         return 0
 
@@ -363,7 +420,7 @@ def get_pending_review_category(redis_client, user_id):
         val = redis_client.get(f"pending_review_category:{user_id}")
         if val is None:
             return None
-        return val.decode("utf-8") if hasattr(val, "decode") else str(val)
+        return val
     except Exception:
         return None
 
@@ -394,7 +451,7 @@ def get_last_assistant_message(redis_client, user_id):
         val = redis_client.get(f"last_assistant_message:{user_id}")
         if val is None:
             return None
-        return val.decode("utf-8") if hasattr(val, "decode") else str(val)
+        return val
     except Exception:
         return None
 
@@ -427,9 +484,8 @@ def get_conv_history(redis_client, user_id):
         items = redis_client.lrange(key, 0, -1) or []
         result = []
         for item in items:
-            raw = item.decode("utf-8") if isinstance(item, bytes) else str(item)
             try:
-                result.append(json.loads(raw))
+                result.append(json.loads(item))
             except Exception:
                 pass
         return result
@@ -443,6 +499,20 @@ def generate_socratic_question(openai_client, last_interaction_context):
     return q
 
 
+def _parse_open_quiz(text):
+    """解析 JSON mode 回傳的開放式簡答題，回傳 (question_text, answer_criteria, category)；無題目時回傳 None。"""
+    try:
+        obj = json.loads((text or "").strip())
+    except Exception:
+        return None
+    q = (obj.get("question") or "").strip()[:400]
+    a = (obj.get("answer_criteria") or "").strip()[:600]
+    c = (obj.get("category") or "其他").strip()[:20]
+    if not q:
+        return None
+    return (("小測驗：" + q) if not q.startswith("小測驗") else q, a or q, c or "其他")
+
+
 def generate_dynamic_quiz(openai_client, discussed_topic=None, last_context=None, week_topic=None):
     """
     出題邏輯：若 discussed_topic 存在，針對「剛才討論的主題」出開放式簡答題；
@@ -469,21 +539,11 @@ def generate_dynamic_quiz(openai_client, discussed_topic=None, last_context=None
                     {"role": "user", "content": f"剛才討論的主題（使用者問的）：{topic_str}{context_str}\n\n請針對此主題出一道開放式簡答題，回傳 JSON。"},
                 ],
                 max_tokens=350,
+                response_format={"type": "json_object"},
             )
-            text = (resp.choices[0].message.content or "").strip()
-            for block in (text.split("```"), [text]):
-                for raw in block:
-                    raw = raw.strip()
-                    if raw.startswith("{"):
-                        try:
-                            obj = json.loads(raw.split("```")[0].strip().split("\n")[0])
-                            q = (obj.get("question") or "").strip()[:400]
-                            a = (obj.get("answer_criteria") or "").strip()[:600]
-                            c = (obj.get("category") or "其他").strip()[:20]
-                            if q:
-                                return (("小測驗：" + q) if not q.startswith("小測驗") else q, a or q, c or "其他")
-                        except Exception:
-                            pass
+            quiz = _parse_open_quiz(resp.choices[0].message.content)
+            if quiz:
+                return quiz
         except Exception:
             traceback.print_exc()
 
@@ -516,21 +576,11 @@ def generate_dynamic_quiz(openai_client, discussed_topic=None, last_context=None
                 {"role": "user", "content": f"本週主題：{topic}{context_hint}\n\n請出一道小測驗，回傳 JSON。"},
             ],
             max_tokens=350,
+            response_format={"type": "json_object"},
         )
-        text = (resp.choices[0].message.content or "").strip()
-        for block in (text.split("```"), [text]):
-            for raw in block:
-                raw = raw.strip()
-                if raw.startswith("{"):
-                    try:
-                        obj = json.loads(raw.split("```")[0].strip().split("\n")[0])
-                        q = (obj.get("question") or "").strip()[:400]
-                        a = (obj.get("answer_criteria") or "").strip()[:600]
-                        c = (obj.get("category") or "其他").strip()[:20]
-                        if q:
-                            return (("小測驗：" + q) if not q.startswith("小測驗") else q, a or q, c or "其他")
-                    except Exception:
-                        pass
+        quiz = _parse_open_quiz(resp.choices[0].message.content)
+        if quiz:
+            return quiz
     except Exception:
         traceback.print_exc()
 
@@ -600,21 +650,18 @@ def judge_quiz_answer(openai_client, topic_or_question, student_reply, answer_cr
                 },
             ],
             max_tokens=350,
+            response_format={"type": "json_object"},
         )
         text = (resp.choices[0].message.content or "").strip()
-        for block in (text.split("```"), [text]):
-            for raw in block:
-                raw = raw.strip()
-                if raw.startswith("{"):
-                    try:
-                        obj = json.loads(raw.split("\n")[0].strip())
-                        return (
-                            (obj.get("feedback") or "謝謝你的回答！").strip()[:600],
-                            (obj.get("category") or "其他").strip()[:20],
-                            bool(obj.get("correct", True)),
-                        )
-                    except Exception:
-                        pass
+        try:
+            obj = json.loads(text)
+            return (
+                (obj.get("feedback") or "謝謝你的回答！").strip()[:600],
+                (obj.get("category") or "其他").strip()[:20],
+                bool(obj.get("correct", True)),
+            )
+        except Exception:
+            pass
         return (text[:400] or "謝謝你的回答！", "其他", True)
     except Exception as e:
         traceback.print_exc()
@@ -93,6 +93,39 @@ def increment_user_interaction_count(db, user_id):
 DEFAULT_INTENT_TAG = "General"
 
 
+def _json_schema_format(name, properties):
+    """OpenAI structured outputs（strict）的 response_format；所有欄位皆必填。"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+_INTENT_COMPLEXITY_FORMAT = _json_schema_format("qa_intent_complexity", {
+    "intent_tag": {"type": "string", "enum": list(INTENT_TAGS)},
+    "complexity_score": {"type": "integer"},
+})
+_LEARNING_TAGS_FORMAT = _json_schema_format("qa_learning_tags", {
+    "intent_tag": {"type": "string", "enum": list(LEARNING_INTENT_TAGS)},
+    "complexity_level": {"type": "string", "enum": list(COMPLEXITY_LEVELS)},
+})
+_REVIEW_QUIZ_FORMAT = _json_schema_format("review_quiz", {
+    "question": {"type": "string"},
+    "options": {"type": "array", "items": {"type": "string"}},
+    "answer": {"type": "string", "enum": ["A", "B", "C"]},
+    "explanation": {"type": "string"},
+})
+
+
 def classify_qa_intent_and_complexity(openai_client, question, timeout_sec=5):
     """
     使用 LLM 將使用者問題分類為 intent_tag (Memory/Understanding/Application) 與 complexity_score (1-5)。
@@ -114,12 +147,11 @@ def classify_qa_intent_and_complexity(openai_client, question, timeout_sec=5):
             max_tokens=80,
             temperature=0.1,
             timeout=timeout_sec,
+            response_format=_INTENT_COMPLEXITY_FORMAT,
         )
         raw = (resp.choices[0].message.content or "").strip()
         if not raw:
             return DEFAULT_INTENT_TAG, None
-        if "{" in raw and "}" in raw:
-            raw = raw[raw.find("{"): raw.rfind("}") + 1]
         obj = json.loads(raw)
         intent = (obj.get("intent_tag") or "").strip()
         if intent not in INTENT_TAGS:
@@ -162,11 +194,11 @@ def classify_qa_learning_tags(openai_client, question, timeout_sec=5):
             max_tokens=80,
             temperature=0.1,
             timeout=timeout_sec,
+            response_format=_LEARNING_TAGS_FORMAT,
         )
         raw = (resp.choices[0].message.content or "").strip()
-        if not raw or "{" not in raw or "}" not in raw:
+        if not raw:
             return None, None
-        raw = raw[raw.find("{"): raw.rfind("}") + 1]
         obj = json.loads(raw)
         intent = (obj.get("intent_tag") or "").strip()
         if intent not in LEARNING_INTENT_TAGS:
@@ -378,14 +410,11 @@ def log_quiz_result(db, user_id, quiz_type, question_id, user_answer, is_correct
 
 def count_tcm_terms_in_text(text):
     """計算 text 中出現的 TCM 專業術語次數（重複出現多次計多次）。"""
-    if not (text or "").strip():
-        return 0
     text = (text or "").strip()
-    count = 0
-    for term in TCM_TERMS_FOR_SPEECH:
-        if term in text:
-            count += text.count(term)
-    return count
+    if not text:
+        return 0
+    # str.count 本身即一次 C 層掃描；術語間可重疊（如「手太陰」與「陰陽」），故逐詞計數而非合併成單一 regex
+    return sum(map(text.count, TCM_TERMS_FOR_SPEECH))
 
 
 def log_speaking(db, user_id, transcript_length, tcm_term_count, transcript=None):
@@ -541,11 +570,11 @@ def generate_review_quiz_from_interactions(db, user_id, openai_client, last_n=10
             ],
             max_tokens=250,
             temperature=0.2,
+            response_format=_REVIEW_QUIZ_FORMAT,
         )
         raw = (resp.choices[0].message.content or "").strip()
-        if not raw or "{" not in raw or "}" not in raw:
+        if not raw:
             return None
-        raw = raw[raw.find("{"): raw.rfind("}") + 1]
         obj = json.loads(raw)
         question = (obj.get("question") or "").strip()
         options = obj.get("options") or []
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+語意回覆快取：相近提問（同模式）直接沿用先前 AI 回覆，跳過 Assistant / Chat 呼叫。
+提問先去除客套／疑問虛詞取出「關鍵詞序列」，依其 hash 分桶：只有關鍵詞完全相同（如「什麼是陰虛」與「陰虛是什麼？」）
+才會落在同一桶，「陰虛」與「陽虛」這類只差一字的醫學提問永遠不會互相命中。
+桶內先比對正規化文字（完全相同即命中，不需 embedding），再以 text-embedding-3-small 向量 cosine 做嚴格比對。
+向量以 int8 量化後 base64 存放，每次查詢只讀取單一小桶。
+所有操作均 guard redis_client / openai_client，失敗時視為 miss，不影響主流程。
+"""
+
+import base64
+import hashlib
+import json
+import math
+import os
+import re
+
+SEMCACHE_KEY = "semcache:{mode}:{bucket}"
+SEMCACHE_MAX = 20  # 每個關鍵詞桶保留最近 N 筆
+SEMCACHE_TTL = 7 * 24 * 3600
+SEMCACHE_MODEL = "text-embedding-3-small"
+SEMCACHE_DIMENSIONS = 256  # 縮短向量以減少 Redis 傳輸量與比對成本
+SEMCACHE_THRESHOLD = float(os.getenv("SEMCACHE_THRESHOLD", "0.96"))
+SEMCACHE_ENABLED = os.getenv("SEMCACHE_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+
+# 不影響題意的客套／疑問虛詞；刻意不含否定詞（不、沒、非）與「為」「會」等會改變語意的字
+_FILLER_RE = re.compile(r"請問|请问|什麼|什么|甚麼|一下|[嗎吗呢吧啊呀的是]")
+_EN_STOPWORDS = frozenset(
+    ("a", "an", "the", "is", "are", "what", "whats", "please", "tell", "me", "about", "can", "could", "you", "explain", "of")
+)
+_TERM_RE = re.compile(r"[a-z0-9]+|[㐀-鿿]")
+
+
+def _normalize_text(text):
+    """去除首尾空白、合併連續空白並轉小寫，讓僅差在格式的提問共用同一向量。"""
+    return " ".join((text or "").split()).lower()
+
+
+def _key_terms(text):
+    """去除虛詞與標點後的關鍵詞序列（保留順序），作為分桶依據。"""
+    t = _FILLER_RE.sub(" ", _normalize_text(text))
+    return " ".join(w for w in _TERM_RE.findall(t) if w not in _EN_STOPWORDS)
+
+
+def _bucket_key(text, mode):
+    terms = _key_terms(text)
+    if not terms:
+        return None
+    digest = hashlib.sha1(terms.encode("utf-8")).hexdigest()[:16]
+    return SEMCACHE_KEY.format(mode=mode, bucket=digest)
+
+
+def _unit(vec):
+    norm = math.sqrt(sum(x * x for x in vec))
+    if not norm:
+        return None
+    return [x / norm for x in vec]
+
+
+def _pack(vec):
+    """單位向量 int8 量化後 base64（256 維約 344 bytes，JSON 浮點數列約 2KB）。"""
+    q = bytes((max(-127, min(127, round(x * 127))) & 0xFF) for x in vec)
+    return base64.b64encode(q).decode("ascii")
+
+
+def _unpack(packed):
+    raw = base64.b64decode(packed)
+    return _unit([(b - 256 if b > 127 else b) / 127 for b in raw])
+
+
+def embed_text(openai_client, text):
+    """取得正規化後文字的單位向量；失敗回傳 None。"""
+    t = _normalize_text(text)
+    if not openai_client or not t:
+        return None
+    try:
+        resp = openai_client.embeddings.create(
+            model=SEMCACHE_MODEL,
+            input=t[:2000],
+            dimensions=SEMCACHE_DIMENSIONS,
+        )
+        return _unit(resp.data[0].embedding)
+    except Exception as e:
+        print(f"[SEMCACHE] embed failed err={e}")
+        return None
+
+
+def lookup(redis_client, openai_client, text, mode):
+    """
+    查詢語意快取。回傳 (reply, emb)：命中時 reply 為快取回覆，否則為 None；
+    emb 供未命中時呼叫 store 重用。桶為空或正規化文字直接命中時不計算向量，emb 為 None。
+    """
+    if not SEMCACHE_ENABLED or not redis_client or not mode:
+        return None, None
+    key = _bucket_key(text, mode)
+    if not key:
+        return None, None
+    try:
+        items = redis_client.lrange(key, 0, -1) or []
+    except Exception as e:
+        print(f"[SEMCACHE] lookup failed err={e}")
+        return None, None
+    entries = []
+    norm = _normalize_text(text)[:500]
+    for raw in items:
+        try:
+            entry = json.loads(raw)
+        except Exception:
+            continue
+        if entry.get("t") == norm and entry.get("r"):
+            print(f"[SEMCACHE] exact hit mode={mode}")
+            return entry.get("r"), None
+        entries.append(entry)
+    if not entries:
+        return None, None
+    emb = embed_text(openai_client, text)
+    if emb is None:
+        return None, None
+    best_score, best_reply = 0.0, None
+    for entry in entries:
+        try:
+            vec = _unpack(entry.get("v") or "")
+            if not vec or len(vec) != len(emb):
+                continue
+            score = sum(a * b for a, b in zip(emb, vec))
+        except Exception:
+            continue
+        if score > best_score:
+            best_score, best_reply = score, entry.get("r")
+    if best_reply and best_score >= SEMCACHE_THRESHOLD:
+        print(f"[SEMCACHE] hit mode={mode} score={best_score:.3f}")
+        return best_reply, emb
+    return None, emb
+
+
+def store(redis_client, openai_client, text, mode, reply, emb=None):
+    """寫入語意快取（最新在前，超過 SEMCACHE_MAX 筆即截斷）；emb 為 None 時於此計算，適合丟背景執行。"""
+    if not SEMCACHE_ENABLED or not redis_client or not mode or not (reply or "").strip():
+        return
+    key = _bucket_key(text, mode)
+    if not key:
+        return
+    if emb is None:
+        emb = embed_text(openai_client, text)
+        if emb is None:
+            return
+    try:
+        entry = json.dumps(
+            {"t": _normalize_text(text)[:500], "r": reply, "v": _pack(emb)},
+            ensure_ascii=False,
+        )
+        p = redis_client.pipeline(transaction=False)
+        p.lpush(key, entry)
+        p.ltrim(key, 0, SEMCACHE_MAX - 1)
+        p.expire(key, SEMCACHE_TTL)
+        p.execute()
+    except Exception as e:
+        print(f"[SEMCACHE] store failed err={e}")
@@ -14,6 +14,7 @@ import os
 import re
 import json
 from datetime import date, datetime, timezone, timedelta
+from functools import lru_cache
 
 # Asia/Taipei = UTC+8
 TAIPEI_TZ = timezone(timedelta(hours=8))
@@ -32,8 +33,9 @@ _DEFAULT_END_HOUR, _DEFAULT_END_MINUTE = 10, 0
 _LECTURE_FILENAME_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2})_(.+)\.(pdf|docx?|pptx?)$", re.I)
 
 
+@lru_cache(maxsize=1)
 def _load_syllabus_config():
-    """載入 config/syllabus.json（用於 is_off_topic、keywords 等）。"""
+    """載入 config/syllabus.json（用於 is_off_topic、keywords 等）。config 隨部署更新，每個 process 只讀一次；呼叫端勿修改回傳值。"""
     try:
         with open(_CONFIG_PATH, "r", encoding="utf-8") as f:
             return json.load(f)
@@ -48,8 +50,9 @@ def _load_syllabus_config():
         }
 
 
+@lru_cache(maxsize=1)
 def _load_syllabus_full_config():
-    """載入 config/syllabus_full.json（課務查詢用，含 start_time/end_time/has_handout）。若不存在則回傳 None。"""
+    """載入 config/syllabus_full.json（課務查詢用，含 start_time/end_time/has_handout）。若不存在則回傳 None。每個 process 只讀一次。"""
     if not os.path.isfile(_SYLLABUS_FULL_PATH):
         return None
     try:
@@ -126,16 +129,18 @@ def _parse_lecture_dates_from_folder(folder_path):
     return result
 
 
+@lru_cache(maxsize=1)
 def _get_lectures_with_metadata():
     """
     從 config 載入課綱。優先使用 syllabus_full.json（含 end_time、has_handout）；
     否則使用 syllabus.json。
     每筆為 dict：date, title, lecturer,
     has_lecture_materials (或 has_handout), end_hour, end_minute, keywords。
+    解析結果（日期 strptime、排序）每個 process 只做一次，以 tuple 回傳供各呼叫端共用。
     """
     full_cfg = _load_syllabus_full_config()
     if full_cfg:
-        return _get_lectures_from_full(full_cfg)
+        return tuple(_get_lectures_from_full(full_cfg))
 
     cfg = _load_syllabus_config()
     default_meeting = cfg.get("meeting_default") or {}
@@ -160,7 +165,7 @@ def _get_lectures_with_metadata():
         except (ValueError, TypeError):
             continue
     entries.sort(key=lambda e: e["date"])
-    return entries
+    return tuple(entries)
 
 
 def _get_lectures_from_full(full_cfg):
@@ -254,6 +259,11 @@ def _get_ai_highlights_from_json(date_str):
     return [str(h).strip() for h in highlights if str(h).strip()][:10]
 
 
+# 即時生成的 AI 重點依 (日期, 主題) 快取於 process 內：同一週所有使用者看到相同重點，不必每次呼叫 LLM。
+# 寫入新日期時淘汰其他日期的項目，長駐 worker 只保留當週，不會逐日累積。
+_AI_HIGHLIGHTS_CACHE = {}
+
+
 def generate_ai_weekly_highlights(openai_client, lecture_title, max_points=3):
     """
     若該週有講義，調用 OpenAI 根據主題生成 3 個重點。
@@ -292,7 +302,16 @@ def get_ai_weekly_highlights(date_str, lecture_title, openai_client, max_points=
     highlights = _get_ai_highlights_from_json(date_str)
     if highlights:
         return highlights[:max_points]
-    return generate_ai_weekly_highlights(openai_client, lecture_title, max_points)
+    key = ((date_str or "").strip(), (lecture_title or "").strip(), max_points)
+    cached = _AI_HIGHLIGHTS_CACHE.get(key)
+    if cached:
+        return list(cached)
+    highlights = generate_ai_weekly_highlights(openai_client, lecture_title, max_points)
+    if highlights:
+        for stale in [k for k in list(_AI_HIGHLIGHTS_CACHE) if k[0] != key[0]]:
+            _AI_HIGHLIGHTS_CACHE.pop(stale, None)
+        _AI_HIGHLIGHTS_CACHE[key] = tuple(highlights)
+    return highlights
 
 
 def _get_course_inquiry_config():
@@ -424,32 +443,38 @@ def get_allowed_lecture_dates(today=None):
     return set(e[0] for e in entries if e[0] <= today)
 
 
+_STRONG_TCM_RE = re.compile("|".join(map(re.escape, ["中醫", "TCM", "經絡", "穴位", "陰陽", "五行", "針灸", "診斷", "臟腑"])))
+
+
+def _keyword_regex(keywords):
+    """將關鍵字清單編成單一 alternation（長字優先）；清單為空回傳 None。"""
+    kws = sorted({k for k in keywords if k}, key=len, reverse=True)
+    if not kws:
+        return None
+    return re.compile("|".join(map(re.escape, kws)))
+
+
+@lru_cache(maxsize=1)
+def _off_topic_regex():
+    """config 的 off_topic_keywords（小寫）編譯一次；config 隨部署更新，process 內不變。"""
+    cfg = _load_syllabus_config()
+    return _keyword_regex(k.lower() for k in cfg.get("off_topic_keywords", []) if k)
+
+
+@lru_cache(maxsize=4096)
 def is_off_topic(user_text):
     """
     僅針對「明確與中醫/醫療學術無關」之問題（閒聊、娛樂、天氣、飲食推薦）回傳 True。
-    雙重檢查：有 TCM 關鍵字 → 允許；有明確離題關鍵字且無 TCM → 攔截；其餘預設允許。
+    有明確離題關鍵字且無強 TCM 關鍵字 → 攔截；其餘預設允許。
     """
     if not (user_text or "").strip():
         return False
-    cfg = _load_syllabus_config()
-    text_lower = user_text.strip().lower()
+    off_re = _off_topic_regex()
+    if off_re is None:
+        return False
     text = user_text.strip()
-
-    off_keywords = [k for k in cfg.get("off_topic_keywords", []) if k]
-    for kw in off_keywords:
-        if kw and (kw.lower() in text_lower or kw in text):
-            strong_tcm = ["中醫", "TCM", "經絡", "穴位", "陰陽", "五行", "針灸", "診斷", "臟腑"]
-            if any(s in text for s in strong_tcm):
-                break
-            return True
-
-    tcm_keywords = [k for k in cfg.get("tcm_related_keywords", []) if k]
-    if "天氣" in text or "天气" in text:
-        tcm_keywords = [k for k in tcm_keywords if k not in ("氣", "qi")]
-    for kw in tcm_keywords:
-        if kw and (kw.lower() in text_lower or kw in text):
-            return False
-
+    if off_re.search(text.lower()) and not _STRONG_TCM_RE.search(text):
+        return True
     return False
 
 
@@ -459,8 +484,9 @@ OFF_TOPIC_REPLY = (
 )
 
 
+@lru_cache(maxsize=8)
 def get_rag_instructions(today=None):
-    """中醫問答模式：放寬限制，與中醫相關皆可回答；僅攔截完全無關閒聊。"""
+    """中醫問答模式：放寬限制，與中醫相關皆可回答；僅攔截完全無關閒聊。內容固定，每個 process 只組一次。"""
     parts = [
         "【中醫問答模式】",
         "1. 只要問題與中醫、醫療、人體、穴位、經絡、辯證相關，請依專業知識庫或外部學術資源完整回答，不限制講義進度。",
@@ -471,6 +497,7 @@ def get_rag_instructions(today=None):
     return "\n".join(parts)
 
 
+@lru_cache(maxsize=1)
 def get_writing_mode_instructions():
     """
     寫作修訂模式：專屬語言老師 System Prompt。
@@ -490,14 +517,16 @@ def get_writing_mode_instructions():
     )
 
 
+_COURSE_INQUIRY_RE = _keyword_regex([
+    "這堂課", "在學什麼", "學什麼", "進度", "老師", "教授", "課表", "schedule",
+    "course", "課程介紹", "introduction", "上課", "教室", "syllabus", "課務", "本週重點",
+    "評分", "成績", "作業", "繳交", "grading", "assignment",
+])
+
+
+@lru_cache(maxsize=4096)
 def is_course_inquiry_intent(text):
     """偵測課務相關意圖（這堂課在學什麼、進度、老師、課表、評分、作業等）。"""
     if not (text or "").strip():
         return False
-    t = text.strip().lower()
-    keywords = [
-        "這堂課", "在學什麼", "學什麼", "進度", "老師", "教授", "課表", "schedule",
-        "course", "課程介紹", "introduction", "上課", "教室", "syllabus", "課務", "本週重點",
-        "評分", "成績", "作業", "繳交", "grading", "assignment",
-    ]
-    return any(kw in t for kw in keywords)
+    return bool(_COURSE_INQUIRY_RE.search(text.strip().lower()))